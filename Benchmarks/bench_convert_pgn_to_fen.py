@@ -0,0 +1,440 @@
+# bench_convert_pgn_to_fen.py
+# benchmark suite for convert_pgn_to_fen.py
+#
+# run from any directory:
+#   python Benchmarks/bench_convert_pgn_to_fen.py                        print results
+#   python Benchmarks/bench_convert_pgn_to_fen.py --save results.json    also save as JSON
+#   python Benchmarks/bench_convert_pgn_to_fen.py --baseline base.json   compare to an
+#     earlier --save. every result is a rate (higher is better). a result more than
+#     --threshold (default 0.10 = 10%) below the baseline is flagged and the exit code is 1
+#   python Benchmarks/bench_convert_pgn_to_fen.py --check                consistency checks
+#     on the corpus, perft counts of the legal move generator, and rejection of bad moves
+#     and skipping of their games by a process pool, instead of timings. exit code is 1 if any check fails
+#
+# the corpus in Benchmarks/Data is fixed so results are comparable between releases:
+# short_games, long_endgames, commented_games (clock comments, NAGs, variations)
+# and promotion_games. each timing is the best of several repeats
+# the perft positions are the standard test positions with their published node counts
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+from convert_pgn_to_fen import ChessFunctions, GameState, BitboardGameState, ErrorLog, \
+  MoveError, TOKEN_SAN, TOKEN_VARIATION_START, TOKEN_VARIATION_END
+
+DATA_DIR = os.path.join(BENCH_DIR, "Data")
+CORPUS = ["short_games", "long_endgames", "commented_games", "promotion_games"]
+
+# games with a move that cannot be played, and the MoveError reason each must give
+# check_bad_moves() plays each one, check_error_isolation() splices them into a corpus
+BAD_GAMES = [
+  ("1. e4 e5 2. Ke3 Nc6 *", "no piece can make the move"),
+  ("1. e4 e5 2. e5 Nc6 *", "pawn blocked"),                    # push onto a piece
+  ("1. Nf3 e5 2. Nf3h7 *", "no piece can make the move"),      # full hint, not a knight move
+  ("1. e4 e5 2. Ke2 Ke7 3. Ke1 Ke8 4. Nf3 Nf6 5. Bc4 Bc5 6. Ke1g1 *",
+    "castling not allowed"),                                   # king has moved
+  ("1. Nf3 e5 2. Ke1g1 *", "castling not allowed"),            # bishop still on f1
+  ("1. Nc3 e5 2. c4 *", "pawn blocked"),                       # double step over a knight
+  ("1. e4 d5 2. gxd5 *", "malformed pawn move")]               # capture from two files away
+
+# (name, FEN, perft node counts for depth 1, 2, . ., depth timed by the benchmark)
+PERFT_POSITIONS = [
+  ("start", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    [20, 400, 8902, 197281], 3),
+  ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    [48, 2039, 97862], 2),
+  ("position3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    [14, 191, 2812, 43238], 3),
+  ("position4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+    [6, 264, 9467], 2),
+  ("position5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+    [44, 1486, 62379], 2)]
+
+# -------------------------------------------------------------------------------------------------
+
+def corpus_file(name):
+  return os.path.join(DATA_DIR, name + ".pgn")
+
+def corpus_movetexts(name):
+  # list of movetext strings, one per game
+  result = []
+  for headers, movetext in ChessFunctions.iter_games(corpus_file(name)):
+    result.append(movetext)
+  return result
+
+def game_positions(movetext, start_state):
+  # list of (state, san) pairs: each position of the game and the move played from it
+  pairs = []
+  curr = start_state
+  depth = 0  # skip moves inside ( ) variations, like pgn_to_fen()
+  for kind, text in ChessFunctions.tokenize_movetext(movetext):
+    if kind == TOKEN_VARIATION_START: depth += 1
+    elif kind == TOKEN_VARIATION_END: depth -= 1
+    elif kind == TOKEN_SAN and depth == 0:
+      pairs.append((curr, text))
+      curr = ChessFunctions.update_game_state(curr, text)
+  return pairs
+
+def best_time(fn, repeats):
+  # smallest wall time of repeats calls to fn(), least disturbed by other processes
+  best = None
+  for r in range(repeats):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best: best = elapsed
+  return best
+
+# -------------------------------------------------------------------------------------------------
+
+def bench_tokenizer(results, repeats):
+  # single-pass movetext lexer on the comment-heavy corpus
+  movetext = "\n".join(corpus_movetexts("commented_games"))
+  counts = [0]
+  def run():
+    n = 0
+    for token in ChessFunctions.tokenize_movetext(movetext):
+      n += 1
+    counts[0] = n
+  elapsed = best_time(run, repeats)
+  results["tokenize_movetext MB/sec"] = len(movetext) / 1.0e6 / elapsed
+  results["tokenize_movetext tokens/sec"] = counts[0] / elapsed
+
+# -------------------------------------------------------------------------------------------------
+
+def bench_pgn_to_fen(results, repeats):
+  # whole-game replay, plies/sec for each kind of game
+  for name in CORPUS:
+    movetexts = corpus_movetexts(name)
+    counts = [0]
+    def run():
+      n = 0
+      for movetext in movetexts:
+        n += len(ChessFunctions.pgn_to_fen(movetext)) - 1  # first FEN is not a ply
+      counts[0] = n
+    elapsed = best_time(run, repeats)
+    results["pgn_to_fen plies/sec " + name] = counts[0] / elapsed
+
+# -------------------------------------------------------------------------------------------------
+
+def bench_move_analysis(results, repeats):
+  # SAN resolution on every position of the corpus, for both board representations
+  # can_reach() is asked about every square for each piece move in the corpus
+  movetexts = []
+  for name in CORPUS:
+    movetexts += corpus_movetexts(name)
+
+  for (label, cls) in [("GameState", GameState), ("BitboardGameState", BitboardGameState)]:
+    pairs = []
+    for movetext in movetexts:
+      pairs += game_positions(movetext, cls())
+    def run():
+      for (gs, san) in pairs:
+        ChessFunctions.move_analysis(san, gs)
+    elapsed = best_time(run, repeats)
+    results["move_analysis calls/sec " + label] = len(pairs) / elapsed
+
+    if cls == GameState:
+      reach_jobs = []  # (piece, landing square, board) of each piece move
+      boards = []
+      for (gs, san) in pairs:
+        boards.append(gs.board_position)
+        if san[0] in "NBRQK":
+          mar = ChessFunctions.move_analysis(san, gs)
+          reach_jobs.append((san[0], mar.landing_square, gs.board_position))
+
+  def run_reach():
+    for (piece, landing_square, board) in reach_jobs:
+      for sq in range(64):
+        ChessFunctions.can_reach(piece, sq, landing_square, board)
+  elapsed = best_time(run_reach, repeats)
+  results["can_reach calls/sec"] = len(reach_jobs) * 64 / elapsed
+
+  def run_fen():
+    for board in boards:
+      ChessFunctions.board_position_to_fen(board)
+  elapsed = best_time(run_fen, repeats)
+  results["board_position_to_fen calls/sec"] = len(boards) / elapsed
+
+# -------------------------------------------------------------------------------------------------
+
+def bench_fen_emission(results, repeats):
+  # get_fen() per ply in a replay, where the per-rank cache leaves only touched ranks dirty
+  movetexts = corpus_movetexts("short_games") + corpus_movetexts("long_endgames")
+  best = None
+  n = 0
+  for r in range(repeats):
+    t = 0.0
+    n = 0
+    for movetext in movetexts:
+      curr = GameState()
+      curr.get_fen()
+      for kind, text in ChessFunctions.tokenize_movetext(movetext):
+        if kind != TOKEN_SAN: continue
+        ChessFunctions.make_move(curr, text)
+        start = time.perf_counter()
+        curr.get_fen()
+        t += time.perf_counter() - start
+        n += 1
+    if best is None or t < best: best = t
+  results["get_fen plies/sec"] = n / best
+
+# -------------------------------------------------------------------------------------------------
+
+def bench_file_pgn_to_file_fen(results, repeats):
+  # end-to-end file conversion, MB of PGN per second, each corpus file and all of them
+  temp_dir = tempfile.mkdtemp()
+  try:
+    total_bytes = 0
+    total_time = 0.0
+    for name in CORPUS:
+      src = corpus_file(name)
+      dest = os.path.join(temp_dir, name + ".fen")
+      elapsed = best_time(lambda: ChessFunctions.file_pgn_to_file_fen(src, dest), repeats)
+      size = os.path.getsize(src)
+      results["file_pgn_to_file_fen MB/sec " + name] = size / 1.0e6 / elapsed
+      total_bytes += size
+      total_time += elapsed
+    results["file_pgn_to_file_fen MB/sec all"] = total_bytes / 1.0e6 / total_time
+  finally:
+    shutil.rmtree(temp_dir)
+
+# -------------------------------------------------------------------------------------------------
+
+def bench_perft(results, repeats):
+  # legal move generator speed: perft of each standard position at its benchmark depth
+  for (name, fen, counts, depth) in PERFT_POSITIONS:
+    gs = GameState.from_fen(fen)
+    elapsed = best_time(lambda: ChessFunctions.perft(gs, depth), repeats)
+    results["perft nodes/sec " + name] = counts[depth - 1] / elapsed
+
+# -------------------------------------------------------------------------------------------------
+
+def check_perft():
+  # legal_moves() must give the published perft count of every position at every depth
+  # listed, for both board representations. returns number of failures
+  failures = 0
+  for (name, fen, counts, bench_depth) in PERFT_POSITIONS:
+    for cls in [GameState, BitboardGameState]:
+      for depth in range(1, len(counts) + 1):
+        gs = cls.from_fen(fen)
+        start = time.perf_counter()
+        nodes = ChessFunctions.perft(gs, depth)
+        elapsed = time.perf_counter() - start
+        flag = ""
+        if nodes != counts[depth - 1]:
+          flag = "  expected " + str(counts[depth - 1])
+          failures += 1
+        print("%-48s %14d nodes %10.0f nodes/sec%s" % ("perft " + name + " " + \
+          cls.__name__ + " depth " + str(depth), nodes, nodes / elapsed, flag))
+  return failures
+
+# -------------------------------------------------------------------------------------------------
+
+def check_zobrist():
+  # incrementally updated zobrist_key must equal compute_zobrist() after every move and
+  # after every unmake_move(), for both board representations. returns number of failures
+  failures = 0
+  plies = 0
+  for name in CORPUS:
+    for movetext in corpus_movetexts(name):
+      for cls in [GameState, BitboardGameState]:
+        curr = cls()
+        undos = []
+        keys = []
+        depth = 0
+        for kind, text in ChessFunctions.tokenize_movetext(movetext):
+          if kind == TOKEN_VARIATION_START: depth += 1
+          elif kind == TOKEN_VARIATION_END: depth -= 1
+          elif kind == TOKEN_SAN and depth == 0:
+            keys.append(curr.zobrist_key)
+            undos.append(ChessFunctions.make_move(curr, text))
+            plies += 1
+            if curr.zobrist_key != ChessFunctions.compute_zobrist(curr):
+              print("zobrist_key mismatch " + name + " " + cls.__name__ + " after " + text)
+              failures += 1
+        for i in range(len(undos) - 1, -1, -1):
+          ChessFunctions.unmake_move(curr, undos[i])
+          if curr.zobrist_key != keys[i]:
+            print("zobrist_key mismatch " + name + " " + cls.__name__ + " on unmake")
+            failures += 1
+  print("%-48s %14d plies, %d failures" % ("zobrist_key", plies, failures))
+  return failures
+
+# -------------------------------------------------------------------------------------------------
+
+def check_bad_moves():
+  # each game of BAD_GAMES must raise MoveError, with its reason, for both board
+  # representations. returns number of failures
+  failures = 0
+  for (movetext, reason) in BAD_GAMES:
+    for cls in [GameState, BitboardGameState]:
+      try:
+        ChessFunctions.pgn_to_fen(movetext, cls())
+        got = "no error"
+      except MoveError as ex:
+        got = ex.reason
+      if got != reason:
+        print("bad move " + movetext + " " + cls.__name__ + ": " + got + ", expected " + \
+          reason)
+        failures += 1
+  print("%-48s %14d games, %d failures" % ("bad moves", len(BAD_GAMES), failures))
+  return failures
+
+# -------------------------------------------------------------------------------------------------
+
+def check_error_isolation():
+  # a corpus with the BAD_GAMES spliced in must convert the same through
+  # convert_stream_async() on a ProcessPoolExecutor as through file_pgn_to_file_fen():
+  # each bad game is left out and recorded in the ErrorLog under its game number, so its
+  # MoveError has to survive the trip back from the worker process
+  # returns number of failures
+  ifp = open(corpus_file("commented_games"), "r")
+  text = ifp.read()
+  ifp.close()
+  starts = []  # offset of each game
+  start = text.find("[Event ")
+  while start >= 0:
+    starts.append(start)
+    start = text.find("\n[Event ", start)
+    if start >= 0: start += 1
+  pieces = []
+  expected_records = []  # [game, error] of each bad game
+  prev = 0
+  for i in range(len(BAD_GAMES)):
+    j = (i + 1) * len(starts) // (len(BAD_GAMES) + 1)  # goes in before corpus game j
+    pieces.append(text[prev:starts[j]])
+    pieces.append("[Event \"bad\"]\n\n" + BAD_GAMES[i][0] + "\n\n")
+    expected_records.append([j + i, BAD_GAMES[i][1]])
+    prev = starts[j]
+  pieces.append(text[prev:])
+  text = "".join(pieces)
+  temp_dir = tempfile.mkdtemp()
+  try:
+    src = os.path.join(temp_dir, "dirty.pgn")
+    dest = os.path.join(temp_dir, "dirty.fen")
+    ofp = open(src, "w")
+    ofp.write(text)
+    ofp.close()
+    file_log = ErrorLog()
+    ChessFunctions.file_pgn_to_file_fen(src, dest, error_log=file_log)
+    ifp = open(dest, "r")
+    expected = ifp.read()
+    ifp.close()
+  finally:
+    shutil.rmtree(temp_dir)
+
+  async def lines():
+    for line in text.splitlines(True): yield line
+  out = []
+  async def sink(fen_text): out.append(fen_text)
+  stream_log = ErrorLog()
+  executor = ProcessPoolExecutor(2)
+  try:
+    asyncio.run(ChessFunctions.convert_stream_async(lines(), sink, executor,
+      error_log=stream_log))
+  finally:
+    executor.shutdown()
+
+  failures = 0
+  fields = ["game", "ply", "move", "error"]
+  file_records = [[r[f] for f in fields] for r in file_log.records]
+  stream_records = [[r[f] for f in fields] for r in stream_log.records]
+  if [[r["game"], r["error"]] for r in file_log.records] != expected_records:
+    print("error records " + str(file_records) + ", expected " + str(expected_records))
+    failures += 1
+  if stream_records != file_records:
+    print("error records differ: " + str(file_records) + " " + str(stream_records))
+    failures += 1
+  if "".join(out) != expected:
+    print("convert_stream_async output differs from file_pgn_to_file_fen")
+    failures += 1
+  print("%-48s %14d games, %d failures" % ("error isolation process pool", stream_log.games,
+    failures))
+  return failures
+
+# -------------------------------------------------------------------------------------------------
+
+def compare(results, baseline, threshold):
+  # print each result against the baseline. returns the names of the regressions
+  regressions = []
+  print("\n%-48s %14s %14s %8s" % ("benchmark", "baseline", "current", "change"))
+  for name in sorted(results.keys()):
+    if name not in baseline: continue
+    ratio = results[name] / baseline[name]
+    flag = ""
+    if ratio < 1.0 - threshold:
+      flag = "  REGRESSION"
+      regressions.append(name)
+    print("%-48s %14.1f %14.1f %+7.1f%%%s" % \
+      (name, baseline[name], results[name], 100.0 * (ratio - 1.0), flag))
+  return regressions
+
+# -------------------------------------------------------------------------------------------------
+
+def main():
+  parser = argparse.ArgumentParser(description="convert_pgn_to_fen benchmark suite")
+  parser.add_argument("--save", help="write results to this JSON file")
+  parser.add_argument("--baseline", help="JSON file from an earlier --save to compare with")
+  parser.add_argument("--threshold", type=float, default=0.10,
+    help="flag results this fraction below the baseline (default 0.10)")
+  parser.add_argument("--repeats", type=int, default=5, help="timing repeats (default 5)")
+  parser.add_argument("--check", action="store_true",
+    help="run consistency checks on the corpus instead of benchmarks")
+  args = parser.parse_args()
+
+  if args.check == True:
+    print("\nBegin convert_pgn_to_fen checks \n")
+    failures = check_zobrist()
+    failures += check_perft()
+    failures += check_bad_moves()
+    failures += check_error_isolation()
+    print("\nEnd ")
+    if failures > 0: return 1
+    return 0
+
+  print("\nBegin convert_pgn_to_fen benchmarks \n")
+  results = {}
+  bench_tokenizer(results, args.repeats)
+  bench_pgn_to_fen(results, args.repeats)
+  bench_move_analysis(results, args.repeats)
+  bench_fen_emission(results, args.repeats)
+  bench_file_pgn_to_file_fen(results, args.repeats)
+  bench_perft(results, args.repeats)
+  for name in sorted(results.keys()):
+    print("%-48s %14.1f" % (name, results[name]))
+
+  if args.save is not None:
+    report = { "python": platform.python_version(), "platform": platform.platform(),
+      "time": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results }
+    ofp = open(args.save, "w")
+    json.dump(report, ofp, indent=2, sort_keys=True)
+    ofp.close()
+    print("\nResults saved to " + args.save)
+
+  exit_code = 0
+  if args.baseline is not None:
+    ifp = open(args.baseline, "r")
+    baseline = json.load(ifp)["results"]
+    ifp.close()
+    regressions = compare(results, baseline, args.threshold)
+    if len(regressions) > 0:
+      print("\n" + str(len(regressions)) + " regression(s) beyond " + \
+        str(int(100 * args.threshold)) + "% ")
+      exit_code = 1
+
+  print("\nEnd ")
+  return exit_code
+
+if __name__ == "__main__":
+  sys.exit(main())
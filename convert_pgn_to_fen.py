@@ -1,12 +1,213 @@
 # convert_pgn_to_fen.py
 
+import asyncio
+import bz2
+import gzip
+import heapq
+import lzma
+import mmap
+from collections import OrderedDict
+import os
+import json
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 
 # -------------------------------------------------------------------------------------------------
 
+# token kinds emitted by ChessFunctions.tokenize_movetext()
+TOKEN_MOVE_NUMBER = "move_number"  # like "12." or "12..."
+TOKEN_SAN = "san"                  # like "Nbxd2" or "e8=Q+" or "O-O"
+TOKEN_COMMENT = "comment"          # like "{ good move }" or "; to end of line"
+TOKEN_NAG = "nag"                  # like "$14" or "!?"
+TOKEN_VARIATION_START = "("
+TOKEN_VARIATION_END = ")"
+TOKEN_RESULT = "result"            # 1-0 or 0-1 or 1/2-1/2 or *
+
+# one tag pair line like [White "Euwe, Max"]. value can hold \" and \\ escapes
+TAG_PAIR_RE = re.compile(r'^\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+
+# one alternative per token kind, tried in order at each position. one left-to-right pass
+# over the movetext so cost is linear in its length no matter how many comments
+MOVETEXT_TOKEN_RE = re.compile(
+  r"(\{[^}]*\}?)"                # 1 brace comment, can span lines
+  r"|(;[^\n]*)"                  # 2 rest-of-line comment
+  r"|(\$\d+|[!?]{1,2})"           # 3 numeric or suffix annotation glyph
+  r"|(1-0|0-1|1/2-1/2|\*)"        # 4 game termination marker
+  r"|(0-0-0|0-0)"                # 5 castling written with zeros
+  r"|(\d+\.*)"                   # 6 move number, white or black (triple dots)
+  r"|(\()"                       # 7 start of variation
+  r"|(\))"                       # 8 end of variation
+  r"|(e\.p\.)"                   # 9 en passant remark, ignored
+  r"|([A-Za-z][^\s{}();$!?]*)"   # 10 SAN move
+  r"|(\S)")                      # 11 stray character, ignored
+
+# -------------------------------------------------------------------------------------------------
+
+# compressed files, see ChessFunctions.detect_compression() and open_output()
+COMPRESSION_MAGIC = ((b"\x1f\x8b", "gz"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz"))
+COMPRESSION_OPENERS = { "gz": gzip.open, "bz2": bz2.open, "xz": lzma.open }
+PGN_SUFFIXES = (".pgn", ".pgn.gz", ".pgn.bz2", ".pgn.xz")  # what files_pgn_to_files_fen() finds
+
+# -------------------------------------------------------------------------------------------------
+
+def make_move_tables():
+  # per-square move tables, squares 0 (a8) to 63 (h1), computed once at import
+  # knight and king tables hold the squares one jump away. ray tables hold, for each
+  # direction, the squares in order moving away from the square, so the first occupied
+  # square on a ray is the only one that can be reached. board-edge wrap is already
+  # handled: a ray stops at the edge instead of wrapping to the next rank
+  knight_steps = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+  king_steps = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+  bishop_dirs = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+  rook_dirs = [(0, -1), (0, 1), (-1, 0), (1, 0)]
+
+  def jumps(row, col, steps):
+    result = []
+    for (dr, dc) in steps:
+      r = row + dr; c = col + dc
+      if r >= 0 and r <= 7 and c >= 0 and c <= 7:
+        result.append(r * 8 + c)
+    return tuple(result)
+
+  def rays(row, col, dirs):
+    result = []
+    for (dr, dc) in dirs:
+      ray = []
+      r = row + dr; c = col + dc
+      while r >= 0 and r <= 7 and c >= 0 and c <= 7:
+        ray.append(r * 8 + c)
+        r += dr; c += dc
+      if len(ray) > 0:
+        result.append(tuple(ray))
+    return tuple(result)
+
+  knight_targets = []; king_targets = []; bishop_rays = []; rook_rays = []
+  for sq in range(64):
+    row = sq // 8; col = sq % 8
+    knight_targets.append(jumps(row, col, knight_steps))
+    king_targets.append(jumps(row, col, king_steps))
+    bishop_rays.append(rays(row, col, bishop_dirs))
+    rook_rays.append(rays(row, col, rook_dirs))
+  return tuple(knight_targets), tuple(king_targets), tuple(bishop_rays), tuple(rook_rays)
+
+KNIGHT_TARGETS, KING_TARGETS, BISHOP_RAYS, ROOK_RAYS = make_move_tables()
+QUEEN_RAYS = tuple(BISHOP_RAYS[sq] + ROOK_RAYS[sq] for sq in range(64))
+SLIDER_RAYS = { "B": BISHOP_RAYS, "R": ROOK_RAYS, "Q": QUEEN_RAYS }
+
+# squares a pawn on square i captures on, "P" and "p". a white pawn on i attacks j exactly
+# when a black pawn on j would attack i, so PAWN_CAPTURES["p"][j] is also the squares
+# white pawns attack j from (and the other way round)
+PAWN_CAPTURES = { "P": [], "p": [] }
+for sq in range(64):
+  for (pawn, dr) in (("P", -1), ("p", 1)):
+    r = sq // 8 + dr
+    targets = []
+    for c in (sq % 8 - 1, sq % 8 + 1):
+      if r >= 0 and r <= 7 and c >= 0 and c <= 7: targets.append(r * 8 + c)
+    PAWN_CAPTURES[pawn].append(tuple(targets))
+PAWN_CAPTURES = { "P": tuple(PAWN_CAPTURES["P"]), "p": tuple(PAWN_CAPTURES["p"]) }
+
+# the same tables as bitboards (bit i set = square i) for BitboardGameState
+KNIGHT_MASKS = tuple(sum(1 << t for t in KNIGHT_TARGETS[sq]) for sq in range(64))
+KING_MASKS = tuple(sum(1 << t for t in KING_TARGETS[sq]) for sq in range(64))
+FILE_MASKS = dict((f, sum(1 << (r * 8 + i) for r in range(8))) for i, f in enumerate("abcdefgh"))
+RANK_MASKS = dict((str(8 - r), 0xFF << (r * 8)) for r in range(8))
+
+# castling rights as a bitmask, for BitboardGameState
+CASTLE_WHITE_KINGSIDE = 1
+CASTLE_WHITE_QUEENSIDE = 2
+CASTLE_BLACK_KINGSIDE = 4
+CASTLE_BLACK_QUEENSIDE = 8
+CASTLING_SYMBOLS = (("K", CASTLE_WHITE_KINGSIDE), ("Q", CASTLE_WHITE_QUEENSIDE),
+  ("k", CASTLE_BLACK_KINGSIDE), ("q", CASTLE_BLACK_QUEENSIDE))
+# squares that must be empty to castle, between the king and the rook
+CASTLING_PATHS = { "K": (61, 62), "Q": (57, 58, 59), "k": (5, 6), "q": (1, 2, 3) }
+# castling as (king from, king to, rook from, rook to), and the rook's move by where the
+# king lands. the rook's landing square is also the square the king passes over
+CASTLING_MOVES = { "K": (60, 62, 63, 61), "Q": (60, 58, 56, 59), "k": (4, 6, 7, 5),
+  "q": (4, 2, 0, 3) }
+CASTLING_ROOK_MOVES = dict((king_to, (rook_from, rook_to))
+  for (king_from, king_to, rook_from, rook_to) in CASTLING_MOVES.values())
+# castling written as a king move with a full hint, like Ke1g1, and the privilege it needs
+CASTLING_KING_MOVES = { "e1g1": "K", "e1c1": "Q", "e8g8": "k", "e8c8": "q" }
+# privileges lost when a move leaves or lands on the square of a king or rook
+CASTLING_LOST = { 60: "KQ", 56: "Q", 63: "K", 4: "kq", 0: "q", 7: "k" }
+
+# -------------------------------------------------------------------------------------------------
+
+def make_zobrist_tables(seed=20240501):
+  # random 64-bit keys for Zobrist hashing. a position key is the XOR of the keys of
+  # everything in the position, so a move changes it with a few XORs. fixed seed so
+  # keys are the same in every run and every process
+  rng = random.Random(seed)
+  pieces = {}
+  for piece in "PNBRQKpnbrqk":
+    pieces[piece] = tuple(rng.getrandbits(64) for sq in range(64))
+  castling = {}
+  for symbol in "KQkq":
+    castling[symbol] = rng.getrandbits(64)
+  ep_files = {}
+  for f in "abcdefgh":
+    ep_files[f] = rng.getrandbits(64)
+  black_to_move = rng.getrandbits(64)
+  return pieces, castling, ep_files, black_to_move
+
+ZOBRIST_PIECES, ZOBRIST_CASTLING, ZOBRIST_EP_FILES, ZOBRIST_BLACK_TO_MOVE = make_zobrist_tables()
+
+# -------------------------------------------------------------------------------------------------
+
+# fixed-width binary position record, an alternative to a FEN line. see pgn_to_records()
+# board is 4 bits per square, two squares per byte (low nibble = even square), each a code
+# into POSITION_PIECE_CODES (0 = empty). castling is a CASTLE_ bitmask. ep_file is 0-7 for
+# files a-h, NO_EP_FILE when there is no e.p. square. little-endian so files are portable
+POSITION_PIECE_CODES = "1PNBRQKpnbrqk"
+POSITION_CODE_TABLE = str.maketrans(dict((piece, chr(code))
+  for code, piece in enumerate(POSITION_PIECE_CODES)))
+POSITION_DTYPE = np.dtype([("board", np.uint8, (32,)), ("white_to_move", np.uint8),
+  ("castling", np.uint8), ("ep_file", np.uint8), ("fifty_move_ctr", "<u2"),
+  ("full_move_ctr", "<u2")])  # 39 bytes
+NO_EP_FILE = 255
+
+# pgn_to_planes(): plane i is piece code PLANE_CODES[i], and column j of the castling
+# features is bit CASTLING_BITS[j]
+PLANE_CODES = np.arange(1, 13, dtype=np.uint8)
+CASTLING_BITS = np.array([bit for (symbol, bit) in CASTLING_SYMBOLS], dtype=np.uint8)
+
+# castling FEN text like "KQk" -> CASTLE_ bitmask, for every combination in KQkq order
+CASTLING_MASKS = { "-": 0 }
+for mask in range(1, 16):
+  CASTLING_MASKS["".join(symbol for (symbol, bit) in CASTLING_SYMBOLS if mask & bit)] = mask
+
+# -------------------------------------------------------------------------------------------------
+
+# sidecar game index of a PGN file, see ChessFunctions.index_pgn_file(). the file is
+# GAME_INDEX_MAGIC, the number of source bytes indexed (8 bytes little-endian), then one
+# GAME_INDEX_DTYPE record per game: byte offset and length of the game in the source
+# file and a few key tags. elo 0 = missing, result is an index into GAME_RESULTS
+GAME_INDEX_MAGIC = b"PGNIDX01"
+GAME_INDEX_HEADER_SIZE = 16
+GAME_INDEX_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("white_elo", "<u2"),
+  ("black_elo", "<u2"), ("result", np.uint8), ("date", "S10")])  # 27 bytes
+GAME_RESULTS = ("*", "1-0", "0-1", "1/2-1/2")
+
+# files_pgn_to_files_fen(checkpoint_file=): bytes of a source file converted between
+# progress records in the journal
+CHECKPOINT_INTERVAL = 32 * 1024 * 1024
+
+# -------------------------------------------------------------------------------------------------
+
 class GameState:
   # corresponds loosely to FEN string
-  def __init__(self):
+  # with_key False leaves zobrist_key at 0, for a caller that sets the position and the
+  # key itself (from_fen(), copy_of()) and would throw the computed one away
+  def __init__(self, with_key=True):
     self.board_position = np.empty(64, dtype=object)
     starting = "rnbqkbnr" + "pppppppp" + \
         "11111111" + "11111111" + "11111111" + "11111111" + \
@@ -18,10 +219,13 @@ class GameState:
     self.ep_square = "-"
     self.fifty_move_ctr = 0
     self.full_move_ctr = 1
+    self.rank_fens = [None] * 8  # FEN text of each rank, 0 = rank 8. None = re-encode
+    self.zobrist_key = 0  # 64-bit position key
+    if with_key == True: self.zobrist_key = ChessFunctions.compute_zobrist(self)
 
   @staticmethod  # make a non-starting position state
   def from_fen(fen_string):
-    result = GameState()  # no self. here
+    result = GameState(False)  # no self. here
     tokens = fen_string.split(' ')
     board = ChessFunctions.fen_string_to_board_position(tokens[0])
     for i in range(64):
@@ -31,6 +235,7 @@ class GameState:
     result.ep_square = tokens[3]
     result.fifty_move_ctr = int(tokens[4])
     result.full_move_ctr = int(tokens[5])
+    result.zobrist_key = ChessFunctions.compute_zobrist(result)  # from scratch
     return result
 
   def display(self):
@@ -44,10 +249,28 @@ class GameState:
     print(str(self.full_move_ctr))
 
   def get_fen(self):
-    fen = ChessFunctions.board_position_to_fen(self.board_position) + " " + \
+    fen = self.board_fen() + " " + \
       self.color_to_move + " " + self.castling_info + " " + self.ep_square + " " + \
       str(self.fifty_move_ctr) + " " + str(self.full_move_ctr)
     return fen
+
+  def board_fen(self):
+    # board part of the FEN. only the ranks changed since the last call are re-encoded,
+    # a normal move touches one or two ranks. the rest come from rank_fens
+    ranks = self.rank_fens
+    for r in range(8):
+      if ranks[r] is None:
+        ranks[r] = ChessFunctions.rank_to_fen(self.board_position, r)
+    return "/".join(ranks)
+
+  def set_square(self, square, piece):
+    # write the board through here (not board_position[] directly) so the cached FEN
+    # text of the square's rank is thrown away and the Zobrist key stays current
+    old = self.board_position[square]
+    if old != "1": self.zobrist_key ^= ZOBRIST_PIECES[old][square]
+    if piece != "1": self.zobrist_key ^= ZOBRIST_PIECES[piece][square]
+    self.board_position[square] = piece
+    self.rank_fens[square >> 3] = None
     
   @staticmethod
   def show_board(board_position):
@@ -65,6 +288,136 @@ class GameState:
 
 # -------------------------------------------------------------------------------------------------
 
+class BitboardGameState:
+  # alternative to GameState: same fields and get_fen()/from_fen() contract, but the board
+  # is 12 piece bitboards (Python ints, bit i set = piece on square i, 0 = a8 to 63 = h1)
+  # and castling rights are a bitmask. board_position is a BitboardView so code written
+  # for GameState, like update_game_state() and move_analysis(), runs unchanged
+  PIECES = "PNBRQKpnbrqk"  # bitboards[i] holds piece PIECES[i]
+
+  def __init__(self, with_key=True):  # see GameState
+    self.bitboards = [0] * 12
+    starting = "rnbqkbnr" + "pppppppp" + \
+        "11111111" + "11111111" + "11111111" + "11111111" + \
+        "PPPPPPPP" + "RNBQKBNR"
+    for i in range(64):
+      if starting[i] != "1":
+        self.bitboards[BitboardGameState.PIECES.index(starting[i])] |= 1 << i
+    self.board_position = BitboardView(self)
+    self.color_to_move = "w"
+    self.castling_rights = CASTLE_WHITE_KINGSIDE | CASTLE_WHITE_QUEENSIDE | \
+      CASTLE_BLACK_KINGSIDE | CASTLE_BLACK_QUEENSIDE
+    self.ep_square = "-"
+    self.fifty_move_ctr = 0
+    self.full_move_ctr = 1
+    self.zobrist_key = 0
+    if with_key == True: self.zobrist_key = ChessFunctions.compute_zobrist(self)
+
+  @staticmethod  # make a non-starting position state
+  def from_fen(fen_string):
+    result = BitboardGameState(False)
+    tokens = fen_string.split(' ')
+    board = ChessFunctions.fen_string_to_board_position(tokens[0])
+    result.bitboards = [0] * 12
+    for i in range(64):
+      if board[i] != "1":
+        result.bitboards[BitboardGameState.PIECES.index(board[i])] |= 1 << i
+    result.color_to_move = tokens[1]
+    result.castling_info = tokens[2]
+    result.ep_square = tokens[3]
+    result.fifty_move_ctr = int(tokens[4])
+    result.full_move_ctr = int(tokens[5])
+    result.zobrist_key = ChessFunctions.compute_zobrist(result)
+    return result
+
+  @property
+  def castling_info(self):
+    # castling bitmask as FEN text like "KQkq" or "Kq" or "-"
+    info = ""
+    for (symbol, bit) in CASTLING_SYMBOLS:
+      if self.castling_rights & bit: info += symbol
+    if info == "": info = "-"
+    return info
+
+  @castling_info.setter
+  def castling_info(self, info):
+    self.castling_rights = 0
+    for (symbol, bit) in CASTLING_SYMBOLS:
+      if symbol in info: self.castling_rights |= bit
+
+  def set_square(self, square, piece):
+    # same as GameState.set_square(). there is no FEN cache to invalidate here
+    old = self.board_position[square]
+    if old != "1": self.zobrist_key ^= ZOBRIST_PIECES[old][square]
+    if piece != "1": self.zobrist_key ^= ZOBRIST_PIECES[piece][square]
+    self.board_position[square] = piece
+
+  def occupied(self):
+    # bitboard of all pieces, both colors
+    result = 0
+    for bb in self.bitboards:
+      result |= bb
+    return result
+
+  def copy(self):
+    # copy by value. ints are immutable so copying the list is enough
+    result = BitboardGameState(False)
+    result.bitboards = list(self.bitboards)
+    result.color_to_move = self.color_to_move
+    result.castling_rights = self.castling_rights
+    result.ep_square = self.ep_square
+    result.fifty_move_ctr = self.fifty_move_ctr
+    result.full_move_ctr = self.full_move_ctr
+    result.zobrist_key = self.zobrist_key
+    return result
+
+  def display(self):
+    GameState.show_board(self.board_position)
+    print(self.get_fen())
+
+  def get_fen(self):
+    squares = ["1"] * 64
+    for i in range(12):
+      bb = self.bitboards[i]
+      while bb:
+        low = bb & -bb  # lowest set bit
+        squares[low.bit_length() - 1] = BitboardGameState.PIECES[i]
+        bb ^= low
+    fen = ChessFunctions.board_position_to_fen(squares) + " " + \
+      self.color_to_move + " " + self.castling_info + " " + self.ep_square + " " + \
+      str(self.fifty_move_ctr) + " " + str(self.full_move_ctr)
+    return fen
+
+# -------------------------------------------------------------------------------------------------
+
+class BitboardView:
+  # looks like a GameState board_position array of 64 one-character strings,
+  # "1" for empty, but reads and writes the bitboards of a BitboardGameState
+  def __init__(self, state):
+    self.state = state
+
+  def __len__(self):
+    return 64
+
+  def __getitem__(self, square):
+    bit = 1 << square
+    bitboards = self.state.bitboards
+    for i in range(12):
+      if bitboards[i] & bit:
+        return BitboardGameState.PIECES[i]
+    return "1"
+
+  def __setitem__(self, square, piece):
+    bit = 1 << square
+    bitboards = self.state.bitboards
+    for i in range(12):
+      if bitboards[i] & bit:
+        bitboards[i] ^= bit  # clear whatever was there
+    if piece != "1":
+      bitboards[BitboardGameState.PIECES.index(piece)] |= bit
+
+# -------------------------------------------------------------------------------------------------
+
 class MoveAnalysisResults:
   # return value for move_analysis()
   # container class for all the info needed for update_game_state()
@@ -99,16 +452,708 @@ class MoveAnalysisResults:
 
 # -------------------------------------------------------------------------------------------------
 
+class MoveError(ValueError):
+  # raised by make_move() (and move_analysis()) for a move that cannot be played in the
+  # position: SAN too garbled to read, no piece that can make the move, or two that can
+  # make_move() raises before it changes the state
+  # move is the SAN as written, ply the number of moves played before it (0 = white's
+  # first move), reason what was wrong
+  def __init__(self, move, gs, reason):
+    ply = 2 * (gs.full_move_ctr - 1)
+    if gs.color_to_move == "b": ply += 1
+    self.set_fields(move, ply, reason)
+
+  def set_fields(self, move, ply, reason):
+    self.move = move
+    self.ply = ply
+    self.reason = reason
+    ValueError.__init__(self, reason + ": " + str(move) + " at ply " + str(ply))
+
+  def __reduce__(self):
+    # pickled as (move, ply, reason), not the constructor arguments, so a MoveError raised
+    # in a ProcessPoolExecutor worker comes back intact to the parent process
+    return (MoveError.from_fields, (self.move, self.ply, self.reason))
+
+  @staticmethod
+  def from_fields(move, ply, reason):
+    ex = MoveError.__new__(MoveError)
+    ex.set_fields(move, ply, reason)
+    return ex
+
+# -------------------------------------------------------------------------------------------------
+
+class Instrumentation:
+  # opt-in profiling for file_pgn_to_file_fen(), pgn_to_fen() and files_pgn_to_files_fen()
+  # pass one as instr= and the code charges wall time to stages as it goes:
+  # read (file reading and game splitting), tokenize (movetext lexing), copy (GameState
+  # copies), analysis (SAN resolution in move_analysis()), update (board and field
+  # updates), fen (FEN encoding), encode (binary records), cache (OpeningCache lookups
+  # and copies), filter (tag-pair parsing for a GameFilter), write (output).
+  # with instr=None (the default) the only
+  # cost is an "is not None" test per stage
+  def __init__(self):
+    self.stage_seconds = {}  # stage name -> total seconds
+    self.stage_calls = {}    # stage name -> number of times charged
+    self.games = 0
+    self.plies = 0
+    self.wall_seconds = 0.0  # between begin() and end() calls
+    self.last_mark = time.perf_counter()
+    self.begin_time = None
+
+  def mark(self, stage):
+    # charge the time since the previous mark to stage. stage None just restarts the clock
+    now = time.perf_counter()
+    if stage is not None:
+      self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + (now - self.last_mark)
+      self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+    self.last_mark = now
+
+  def begin(self):
+    # start of a top-level call. nested calls (pgn_to_fen inside file_pgn_to_file_fen) are
+    # ignored so wall time is not counted twice
+    self.mark(None)
+    if self.begin_time is None:
+      self.begin_time = self.last_mark
+      return True
+    return False
+
+  def end(self, began):
+    # began is what the matching begin() returned
+    if began == True:
+      self.wall_seconds += time.perf_counter() - self.begin_time
+      self.begin_time = None
+
+  def merge(self, other):
+    # add in the counts of another Instrumentation, like one returned by a worker process
+    for stage in other.stage_seconds:
+      self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + other.stage_seconds[stage]
+      self.stage_calls[stage] = self.stage_calls.get(stage, 0) + other.stage_calls[stage]
+    self.games += other.games
+    self.plies += other.plies
+
+  def summary(self):
+    # everything as a dict of plain numbers, ready for json
+    stages = {}
+    for stage in self.stage_seconds:
+      stages[stage] = { "seconds": self.stage_seconds[stage], "calls": self.stage_calls[stage] }
+    wall = self.wall_seconds
+    if wall == 0.0:
+      wall = sum(self.stage_seconds.values())
+    result = { "stages": stages, "games": self.games, "plies": self.plies,
+      "wall_seconds": wall, "games_per_sec": 0.0, "plies_per_sec": 0.0 }
+    if wall > 0.0:
+      result["games_per_sec"] = self.games / wall
+      result["plies_per_sec"] = self.plies / wall
+    return result
+
+  def to_json(self):
+    return json.dumps(self.summary(), indent=2, sort_keys=True)
+
+  def display(self):
+    summ = self.summary()
+    total = sum(self.stage_seconds.values())
+    for stage in sorted(self.stage_seconds, key=self.stage_seconds.get, reverse=True):
+      secs = self.stage_seconds[stage]
+      pct = 0.0
+      if total > 0.0: pct = 100.0 * secs / total
+      print("%-10s %10.3f sec %6.1f%% %12d calls" % (stage, secs, pct, self.stage_calls[stage]))
+    print("games = " + str(self.games) + "  plies = " + str(self.plies) + \
+      "  wall = %0.3f sec" % summ["wall_seconds"])
+    print("games/sec = %0.1f  plies/sec = %0.1f" % (summ["games_per_sec"], summ["plies_per_sec"]))
+
+# -------------------------------------------------------------------------------------------------
+
+class ErrorLog:
+  # the games convert_games() skipped because a move raised a MoveError. pass one as
+  # error_log= to file_pgn_to_file_fen() and friends: a bad game costs only the moves
+  # replayed up to the error and the rest of the file is converted as usual
+  # each record is a dict: file (source file, None for a stream), game (number of the
+  # game in the file, 0 = first, numbered like the sidecar index so read_indexed_game()
+  # fetches it), ply and move (see MoveError) and error (the reason)
+  # with error_file, records are also appended to that file as JSON lines as they come in
+  def __init__(self, error_file=None):
+    self.error_file = error_file
+    self.records = []
+    self.games = 0  # games seen, good or bad
+    self.source_file = None
+    self.game = -1  # number of the game being converted
+
+  def number_games(self, games, source_file=None, first=0):
+    # generator: the (headers, movetext) games passed through, counted so that a record
+    # knows which game of source_file it is about. first is the number of the first one
+    self.source_file = source_file
+    self.game = first - 1
+    for game in games:
+      self.game += 1
+      self.games += 1
+      yield game
+
+  def add_error(self, ex):
+    # record MoveError ex of the current game
+    self.add({ "file": self.source_file, "game": self.game, "ply": ex.ply, "move": ex.move,
+      "error": ex.reason })
+
+  def add(self, record):
+    self.records.append(record)
+    if self.error_file is not None:
+      ofp = open(self.error_file, "a")
+      ofp.write(json.dumps(record) + "\n")
+      ofp.close()
+
+  def merge(self, other, first_game=0):
+    # add in the records of another ErrorLog, like one returned by a worker process
+    # first_game is added to their game numbers, for a worker that started mid-file
+    for record in other.records:
+      record = dict(record)
+      record["game"] += first_game
+      self.add(record)
+    self.games += other.games
+
+  def summary(self):
+    # counts of skipped games by reason, as a dict of plain numbers ready for json
+    reasons = {}
+    for record in self.records:
+      reasons[record["error"]] = reasons.get(record["error"], 0) + 1
+    return { "games": self.games, "skipped": len(self.records), "reasons": reasons }
+
+  def display(self):
+    for record in self.records:
+      print(str(record["file"]) + "  game " + str(record["game"]) + "  ply " + \
+        str(record["ply"]) + "  " + str(record["move"]) + "  " + record["error"])
+    print("games = " + str(self.games) + "  skipped = " + str(len(self.records)))
+
+# -------------------------------------------------------------------------------------------------
+
+class OpeningCacheNode:
+  # one position in an OpeningCache trie, reached by playing move from parent
+  def __init__(self, parent, move, state, fen):
+    self.parent = parent
+    self.move = move
+    self.state = state        # private copy, never played on
+    self.fen = fen
+    self.children = {}        # SAN move -> OpeningCacheNode
+    self.alive = True         # False once evicted
+
+# -------------------------------------------------------------------------------------------------
+
+class OpeningCache:
+  # positions reached by the opening moves of earlier games, for pgn_to_fen(cache=).
+  # a trie of SAN moves from the standard starting position, each node holding the
+  # GameState and FEN after its moves, so a game that starts like an earlier one resumes
+  # from the longest cached prefix instead of replaying it. at most max_plies deep and
+  # max_entries nodes. past that the least recently used node is evicted with its subtree
+  # (ancestors are always used more recently than descendants, so that is almost always
+  # a leaf)
+  def __init__(self, max_entries=100000, max_plies=20):
+    self.max_entries = max_entries
+    self.max_plies = max_plies
+    start = GameState()
+    self.root = OpeningCacheNode(None, None, start, start.get_fen())
+    self.lru = OrderedDict()  # id(node) -> node, least recently used first. not root
+    self.games = 0
+    self.hits = 0          # games that resumed from a cached prefix
+    self.plies = 0         # plies of all games looked up
+    self.plies_reused = 0  # plies taken from the cache instead of replayed
+    self.evictions = 0
+
+  def touch(self, node):
+    self.lru.move_to_end(id(node))
+
+  def add(self, parent, move, state, fen):
+    # new child of parent, returns it. None if parent has been evicted meanwhile
+    if parent.alive == False: return None
+    node = OpeningCacheNode(parent, move, state, fen)
+    parent.children[move] = node
+    self.lru[id(node)] = node
+    while len(self.lru) > self.max_entries:
+      (key, victim) = self.lru.popitem(last=False)
+      del victim.parent.children[victim.move]
+      self.evict(victim)
+    return node
+
+  def evict(self, node):
+    # node is already out of the lru and its parent. drop its subtree too
+    node.alive = False
+    node.state = None
+    self.evictions += 1
+    for child in node.children.values():
+      del self.lru[id(child)]
+      self.evict(child)
+    node.children = {}
+
+  def clear(self):
+    # drop all cached positions, keep the statistics
+    for node in self.root.children.values():
+      self.evict(node)
+    self.root.children = {}
+    self.lru = OrderedDict()
+
+  def empty_copy(self):
+    # same limits, nothing cached and zero statistics. for a worker process
+    return OpeningCache(self.max_entries, self.max_plies)
+
+  def merge(self, other):
+    # add in the statistics of another OpeningCache, like one returned by a worker process
+    self.games += other.games
+    self.hits += other.hits
+    self.plies += other.plies
+    self.plies_reused += other.plies_reused
+    self.evictions += other.evictions
+
+  def hit_rate(self):
+    # fraction of plies that came from the cache
+    if self.plies == 0: return 0.0
+    return self.plies_reused / self.plies
+
+  def summary(self):
+    return { "entries": len(self.lru), "games": self.games, "hits": self.hits,
+      "plies": self.plies, "plies_reused": self.plies_reused, "evictions": self.evictions,
+      "hit_rate": self.hit_rate() }
+
+  def display(self):
+    print("entries = " + str(len(self.lru)) + " of " + str(self.max_entries) + \
+      "  evictions = " + str(self.evictions))
+    print("games = " + str(self.games) + "  resumed = " + str(self.hits) + \
+      "  plies = " + str(self.plies) + "  reused = " + str(self.plies_reused) + \
+      "  hit rate = %0.3f" % self.hit_rate())
+
+# -------------------------------------------------------------------------------------------------
+
+class GameSplitter:
+  # groups PGN text lines into (headers, movetext) games, one line at a time, for
+  # iter_games_from_lines() and for readers that are not plain iterables (asyncio streams)
+  # a game starts with its tag pairs. a tag pair line seen after movetext means the
+  # previous game is complete
+  def __init__(self):
+    self.headers = []
+    self.movetext = []
+
+  def feed(self, line):
+    # returns the previous game when line completes it, else None
+    if line.startswith("["):
+      game = None
+      if len(self.movetext) > 0:  # tag-pair boundary so previous game done
+        game = (self.headers, "".join(self.movetext))
+        self.headers = []
+        self.movetext = []
+      self.headers.append(line.strip())
+      return game
+    if line.startswith("%"): return None  # PGN escape mechanism line
+    if line.strip() == "": return None    # blank lines separate sections
+    self.movetext.append(line)
+    return None
+
+  def finish(self):
+    # the last game at end of input, or None if there is nothing left
+    if len(self.headers) == 0 and len(self.movetext) == 0: return None
+    game = (self.headers, "".join(self.movetext))
+    self.headers = []
+    self.movetext = []
+    return game
+
+# -------------------------------------------------------------------------------------------------
+
+class OutputSink:
+  # where file_pgn_to_file_fen() puts the positions of each game. positions are buffered
+  # and written batch_size at a time, to dest_file + ".tmp", which close() renames to
+  # dest_file. so a crashed run never leaves a half-written dest_file, only the .tmp
+  # use as: with SinkClass(dest) as sink: sink.write(positions) . .
+  # to add a sink, subclass and override open_file() and write_batch() (and positions if
+  # it takes records), then ChessFunctions.register_sink("name", SinkClass) and pass
+  # output_format="name"
+  positions = "fen"        # write() takes a list of FEN strings ("records" = a
+                           # POSITION_DTYPE array from pgn_to_records(), "keyed" = a
+                           # list of (fen, zobrist_key) from pgn_to_fen_keys())
+  can_concatenate = True   # part files of a parallel run can be joined byte by byte
+  can_resume = True        # a .tmp cut back to an earlier size can be appended to
+  can_select = True        # any subset of a game's positions can be written, so a
+                           # PlySelector can be used
+
+  def __init__(self, dest_file, batch_size=8192):
+    self.dest_file = dest_file
+    self.temp_file = dest_file + ".tmp"
+    self.batch_size = batch_size  # positions
+    self.batch = []               # one item per game
+    self.n_buffered = 0
+    self.ofp = None
+
+  def open_file(self, path):
+    return open(path, "w")
+
+  def open_file_append(self, path):
+    return open(path, "a")
+
+  def write_batch(self, ofp, batch):
+    # batch is a list of what write() was given, one item per game
+    return
+
+  def open(self):
+    self.ofp = self.open_file(self.temp_file)
+    return self
+
+  def reopen(self, size):
+    # carry on with the .tmp of an interrupted run, cut back to its first size bytes
+    # (an output_size() taken earlier). only for sinks that can_resume
+    tfp = open(self.temp_file, "r+b")
+    tfp.truncate(size)
+    tfp.close()
+    self.ofp = self.open_file_append(self.temp_file)
+    return self
+
+  def output_size(self):
+    # flush everything and return the size of the .tmp so far, synced to disk
+    self.flush()
+    self.ofp.flush()
+    os.fsync(self.ofp.fileno())
+    return os.fstat(self.ofp.fileno()).st_size
+
+  def detach(self):
+    # close without renaming, leaving the .tmp for reopen() by a later run
+    self.batch = []
+    self.ofp.close()
+
+  def write(self, positions, headers=None):
+    # headers (the game's tag-pair lines) are there for sinks that want them
+    self.batch.append(positions)
+    self.n_buffered += len(positions)
+    if self.n_buffered >= self.batch_size: self.flush()
+
+  def flush(self):
+    if len(self.batch) > 0:
+      self.write_batch(self.ofp, self.batch)
+      self.batch = []
+      self.n_buffered = 0
+
+  def close(self):
+    # write what is left and put the file in place
+    self.flush()
+    self.ofp.close()
+    os.replace(self.temp_file, self.dest_file)
+
+  def abort(self):
+    # drop everything, dest_file is not touched
+    self.batch = []
+    self.ofp.close()
+    if os.path.exists(self.temp_file): os.remove(self.temp_file)
+
+  def __enter__(self):
+    return self.open()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+    return False
+
+# -------------------------------------------------------------------------------------------------
+
+class TextSink(OutputSink):
+  # FEN lines, plain text
+  def write_batch(self, ofp, batch):
+    lines = []
+    for fen_list in batch:
+      lines += fen_list
+    lines.append("")  # for the final newline
+    ofp.write("\n".join(lines))
+
+# -------------------------------------------------------------------------------------------------
+
+class CompressedTextSink(TextSink):
+  # FEN lines through gzip, bz2 or lzma, picked by the dest_file extension (.gz .bz2 .xz)
+  can_resume = False
+  def open_file(self, path):
+    for compression in COMPRESSION_OPENERS:
+      if self.dest_file.endswith("." + compression):
+        return COMPRESSION_OPENERS[compression](path, "wt")
+    return gzip.open(path, "wt")  # no extension to go by
+
+# -------------------------------------------------------------------------------------------------
+
+class BinarySink(OutputSink):
+  # POSITION_DTYPE records, read them back with ChessFunctions.read_position_file()
+  positions = "records"
+  can_select = False
+
+  def open_file(self, path):
+    return open(path, "wb")
+
+  def open_file_append(self, path):
+    return open(path, "ab")
+
+  def write_batch(self, ofp, batch):
+    ofp.write(b"".join([records.tobytes() for records in batch]))
+
+# -------------------------------------------------------------------------------------------------
+
+class SqliteSink(OutputSink):
+  # a SQLite database with tables
+  #   games (id, event, site, date, round, white, black, result, tags, plies)
+  #     the Seven Tag Roster as columns, tags = all tag pairs as a JSON object
+  #   positions (game_id, ply, fen) -- ply 0 is the position before the first move
+  # rows go in with executemany(), one transaction per batch. indexes are created at the
+  # end, when they are cheaper to build than to keep up to date. the database is built
+  # as the .tmp file, so journaling and syncing are turned off while loading
+  # ply and games.plies are counted from the positions written, so every position of
+  # the game is needed: no selector
+  can_concatenate = False
+  can_resume = False
+  can_select = False
+  with_hash = False
+  ROSTER = ("Event", "Site", "Date", "Round", "White", "Black", "Result")
+
+  def __init__(self, dest_file, batch_size=200000):
+    OutputSink.__init__(self, dest_file, batch_size)
+    self.n_games = 0
+
+  def open_file(self, path):
+    if os.path.exists(path): os.remove(path)  # left over from a crashed run
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("CREATE TABLE games (id INTEGER PRIMARY KEY, event TEXT, site TEXT, " + \
+      "date TEXT, round TEXT, white TEXT, black TEXT, result TEXT, tags TEXT, plies INTEGER)")
+    hash_column = ""
+    if self.with_hash == True: hash_column = ", hash INTEGER"
+    conn.execute("CREATE TABLE positions (game_id INTEGER, ply INTEGER, fen TEXT" + \
+      hash_column + ")")
+    return conn
+
+  def write(self, positions, headers=None):
+    if headers is None: headers = []
+    self.batch.append((headers, positions))
+    self.n_buffered += len(positions)
+    if self.n_buffered >= self.batch_size: self.flush()
+
+  def write_batch(self, conn, batch):
+    game_rows = []
+    position_rows = []
+    for (headers, positions) in batch:
+      self.n_games += 1
+      game_id = self.n_games
+      tags = ChessFunctions.parse_tag_pairs(headers)
+      row = [game_id]
+      for name in SqliteSink.ROSTER:
+        row.append(tags.get(name))
+      row.append(json.dumps(tags))
+      row.append(len(positions) - 1)
+      game_rows.append(row)
+      if self.with_hash == True:
+        for ply in range(len(positions)):
+          (fen, key) = positions[ply]
+          if key >= 1 << 63: key -= 1 << 64  # SQLite integers are signed 64-bit
+          position_rows.append((game_id, ply, fen, key))
+      else:
+        for ply in range(len(positions)):
+          position_rows.append((game_id, ply, positions[ply]))
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO games VALUES (?,?,?,?,?,?,?,?,?,?)", game_rows)
+    if self.with_hash == True:
+      conn.executemany("INSERT INTO positions VALUES (?,?,?,?)", position_rows)
+    else:
+      conn.executemany("INSERT INTO positions VALUES (?,?,?)", position_rows)
+    conn.execute("COMMIT")
+
+  def close(self):
+    self.flush()
+    self.ofp.execute("CREATE INDEX positions_game ON positions (game_id, ply)")
+    if self.with_hash == True:
+      self.ofp.execute("CREATE INDEX positions_hash ON positions (hash)")
+    self.ofp.execute("CREATE INDEX games_white ON games (white)")
+    self.ofp.execute("CREATE INDEX games_black ON games (black)")
+    self.ofp.commit()
+    OutputSink.close(self)
+
+# -------------------------------------------------------------------------------------------------
+
+class SqliteHashSink(SqliteSink):
+  # SqliteSink plus positions.hash, the zobrist_key of each position (as a signed 64-bit
+  # integer), indexed, to find every occurrence of a position
+  positions = "keyed"
+  with_hash = True
+
+# -------------------------------------------------------------------------------------------------
+
+# output_format name -> OutputSink class, see ChessFunctions.register_sink() and sink_class()
+OUTPUT_SINKS = { "text": TextSink, "compressed": CompressedTextSink, "binary": BinarySink,
+  "sqlite": SqliteSink, "sqlite_hash": SqliteHashSink }
+
+# -------------------------------------------------------------------------------------------------
+
+class GameFilter:
+  # decides from its tag pairs whether a game is converted, before any move is read
+  # called with the dict from ChessFunctions.parse_tag_pairs(), returns True to convert
+  # every condition given must hold. None (the default) means no condition
+  #   min_elo, max_elo: WhiteElo and BlackElo both in range (a game without them fails)
+  #   date_from, date_to: like "2020.01.01", inclusive. ?? parts of a game's Date count
+  #     as 00, and a game with no year fails
+  #   results: like ["1-0", "0-1"]. events: exact Event names
+  #   players: names, a game passes if White or Black is one of them
+  # any function of the tags dict can be used as a filter too (a plain module-level
+  # function if workers > 1, so it can be pickled)
+  def __init__(self, min_elo=None, max_elo=None, date_from=None, date_to=None,
+    results=None, events=None, players=None):
+    self.min_elo = min_elo
+    self.max_elo = max_elo
+    self.date_from = date_from
+    self.date_to = date_to
+    self.results = None
+    if results is not None: self.results = set(results)
+    self.events = None
+    if events is not None: self.events = set(events)
+    self.players = None
+    if players is not None: self.players = set(players)
+
+  def __call__(self, tags):
+    if self.min_elo is not None or self.max_elo is not None:
+      for tag in ("WhiteElo", "BlackElo"):
+        value = tags.get(tag, "")
+        if value.isdigit() == False: return False
+        elo = int(value)
+        if self.min_elo is not None and elo < self.min_elo: return False
+        if self.max_elo is not None and elo > self.max_elo: return False
+    if self.date_from is not None or self.date_to is not None:
+      date = tags.get("Date", "????")
+      if date[0:4].isdigit() == False: return False
+      date = date.replace("?", "0")
+      if self.date_from is not None and date < self.date_from: return False
+      if self.date_to is not None and date > self.date_to: return False
+    if self.results is not None and tags.get("Result") not in self.results: return False
+    if self.events is not None and tags.get("Event") not in self.events: return False
+    if self.players is not None and tags.get("White") not in self.players and \
+      tags.get("Black") not in self.players: return False
+    return True
+
+# -------------------------------------------------------------------------------------------------
+
+class PlySelector:
+  # picks which positions of a game ChessFunctions.iter_fen() yields. the board is updated
+  # every ply but a FEN string is only made (state.get_fen()) for the positions picked
+  # iter_fen() calls start() once per game, offer(ply, state) for each position (ply 0 is
+  # the position before the first move) and finish(ply, state) with the last position
+  # offer() and finish() return a list of (ply, fen) pairs to yield
+  # this base class picks every position. subclass it for other choices
+  def start(self):
+    return
+
+  def chunk_copy(self, chunk):
+    # the selector for chunk number chunk of a parallel run, sent to a worker process
+    # a selector with state that must differ between chunks returns a new one
+    return self
+
+  def offer(self, ply, state):
+    return [(ply, state.get_fen())]
+
+  def finish(self, ply, state):
+    return []
+
+# -------------------------------------------------------------------------------------------------
+
+class FinalPly(PlySelector):
+  # only the last position of the game
+  def offer(self, ply, state):
+    return []
+
+  def finish(self, ply, state):
+    return [(ply, state.get_fen())]
+
+# -------------------------------------------------------------------------------------------------
+
+class EveryNthPly(PlySelector):
+  # plies first, first + n, first + 2n, . .
+  def __init__(self, n, first=0):
+    self.n = n
+    self.first = first
+
+  def offer(self, ply, state):
+    if ply >= self.first and (ply - self.first) % self.n == 0:
+      return [(ply, state.get_fen())]
+    return []
+
+# -------------------------------------------------------------------------------------------------
+
+class PliesAfterMove(PlySelector):
+  # positions after both sides have played move number move_number (by full_move_ctr,
+  # so also right for games that do not start at move 1)
+  def __init__(self, move_number):
+    self.move_number = move_number
+
+  def offer(self, ply, state):
+    if state.full_move_ctr > self.move_number:
+      return [(ply, state.get_fen())]
+    return []
+
+# -------------------------------------------------------------------------------------------------
+
+class ReservoirSample(PlySelector):
+  # k positions of the game picked uniformly at random (reservoir sampling, all of them if
+  # the game is shorter), yielded in ply order at the end of the game. a FEN is only made
+  # for a position when it goes into the reservoir. seed makes the picks repeatable
+  # (for a parallel run, for the same number of workers)
+  def __init__(self, k, seed=None):
+    self.k = k
+    self.seed = seed
+    self.rng = random.Random(seed)
+    self.reservoir = []
+    self.seen = 0
+
+  def chunk_copy(self, chunk):
+    # its own random sequence, seeded from seed and the chunk number. a pickled copy of
+    # self.rng would make every chunk pick the same plies
+    if self.seed is None: return ReservoirSample(self.k)
+    return ReservoirSample(self.k, str(self.seed) + " " + str(chunk))
+
+  def start(self):
+    self.reservoir = []
+    self.seen = 0
+
+  def offer(self, ply, state):
+    self.seen += 1
+    if len(self.reservoir) < self.k:
+      self.reservoir.append((ply, state.get_fen()))
+    else:
+      j = self.rng.randrange(self.seen)
+      if j < self.k: self.reservoir[j] = (ply, state.get_fen())
+    return []
+
+  def finish(self, ply, state):
+    return sorted(self.reservoir)
+
+# -------------------------------------------------------------------------------------------------
+
 class ChessFunctions:
 
   # ------------------------------------------------------------------------------------------
   # primary: file_pgn_to_file_fen(), pgn_to_fen(), files_pgn_to_files_fen()
-  # secondary: update_game_state() calls move_analysis() calls can_reach()
+  # pgn_to_fen_cached() is pgn_to_fen() with an OpeningCache
+  # iter_fen() is a lazy pgn_to_fen() that yields (ply, fen) for the plies a PlySelector picks
+  # pgn_to_fen_keys() is pgn_to_fen() with the zobrist_key of each position
+  # async: convert_stream_async(), aiter_lines()
+  # compression: detect_compression(), iter_compressed_lines(), open_output()
+  # output: make_sink(), sink_class(), register_sink(), sink_format()
+  # checkpoints: convert_file_checkpointed(), iter_games_with_offsets(),
+  # read_checkpoint_journal(), append_checkpoint(), checkpoint_identity()
+  # index: index_pgn_file(), read_game_index(), scan_game_offsets(), game_index_record(),
+  # file_pgn_games_to_file_fen(), read_indexed_game(), indexed_game_to_fen()
+  # dedup: file_pgn_to_file_unique_fen(), spill_position_run(), iter_position_run()
+  # reading: iter_games(), iter_games_from_lines(), tokenize_movetext(), iter_main_line(),
+  # parse_tag_pairs(), filter_games()
+  # binary: pgn_to_records(), read_position_file(), position_record_to_fen()
+  # planes: pgn_to_planes(), file_pgn_to_file_planes(), read_plane_shards(), replay_boards()
+  # batch: find_pgn_files(), convert_file_job(), convert_games(),
+  # file_pgn_to_file_fen_parallel(), find_game_splits(), follows_movetext(),
+  # convert_chunk_job(), iter_file_lines()
+  # secondary: update_game_state() calls make_move() calls move_analysis() calls can_reach()
+  # then play_move(). unmake_move() takes back a make_move(). a move that cannot be played
+  # raises MoveError, convert_games() drops that game and records it in an ErrorLog
+  # moves: legal_moves() (used by move_analysis() when geometry alone is ambiguous),
+  # square_attacked(), play_move(), perft()
   # helpers: 
   # square_algebraic_to_int(), square_int_to_algebraic(),
   # square_matches_file_hint(), square_matches_rank_hint(),
   # square_color(), square_file(), square_rank(), 
-  # copy_of(), board_position_to_fen_string(), fen_string_to_board_position()
+  # copy_of(), board_position_to_fen_string(), rank_to_fen(), fen_string_to_board_position(),
+  # from_squares(), from_squares_bitboard(), compute_zobrist(), zobrist_castling_ep()
   # ------------------------------------------------------------------------------------------
 
   def __init__(self):
@@ -117,101 +1162,1491 @@ class ChessFunctions:
   # -----------------------------------------------------------------------------------------------
 
   @staticmethod
-  def file_pgn_to_file_fen(source_pgn_file, dest_fen_file):
-    # extract the pgn moves from src file, clean, send to pgn_to_fen(), write results
+  def file_pgn_to_file_fen(source_pgn_file, dest_fen_file, workers=1, instr=None,
+    output_format="text", cache=None, selector=None, game_filter=None, error_log=None):
+    # extract the pgn moves of each game in src file, send to pgn_to_fen(), write results
+    # games are read one at a time by iter_games() so memory does not grow with file size
+    # workers > 1 splits the file at game boundaries and converts the pieces in parallel
+    # instr is an optional Instrumentation to collect per-stage timings
+    # output_format names an OutputSink in OUTPUT_SINKS: "text" writes FEN lines,
+    # "compressed" compressed FEN lines, "binary" POSITION_DTYPE records (read them back
+    # with read_position_file()). dest_fen_file only appears once it is complete
+    # a .gz .bz2 or .xz source is decompressed on the fly (found by its magic bytes or
+    # extension) and read by one worker. "text" to a dest_fen_file ending in .gz .bz2 or
+    # .xz is written compressed
+    # cache is an optional OpeningCache for text output. with workers > 1 each chunk gets
+    # its own empty one and only the statistics come back into cache
+    # selector is an optional PlySelector for text output: only the positions it picks are
+    # written (the cache is not used then). ValueError for a sink that cannot take it
+    # game_filter is an optional GameFilter (or function of the tags dict). games it
+    # rejects are skipped on their tag pairs alone, no move is replayed
+    # a game with a move that cannot be played is left out. error_log is an optional
+    # ErrorLog to record which games were and why
+    output_format = ChessFunctions.sink_format(output_format, dest_fen_file)
+    sink_class = ChessFunctions.sink_class(output_format)  # ValueError if unknown
+    if selector is not None and sink_class.can_select == False:
+      raise ValueError("output format " + output_format + " cannot take a selector")
+    if workers > 1 and ChessFunctions.detect_compression(source_pgn_file) is None and \
+      sink_class.can_concatenate == True:
+      # a compressed stream cannot be split at byte offsets
+      ChessFunctions.file_pgn_to_file_fen_parallel(source_pgn_file, dest_fen_file, workers,
+        instr, output_format, cache, selector, game_filter, error_log)
+      return
+    if instr is not None: began = instr.begin()
+    with ChessFunctions.make_sink(output_format, dest_fen_file) as sink:
+      ChessFunctions.convert_games(ChessFunctions.iter_games(source_pgn_file), sink, instr,
+        cache, selector, game_filter, error_log, source_pgn_file)
+    if instr is not None:
+      instr.mark("write")
+      instr.end(began)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def make_sink(output_format, dest_file):
+    # new OutputSink of the class registered as output_format, for dest_file. not opened
+    return ChessFunctions.sink_class(output_format)(dest_file)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def sink_class(output_format):
+    # the OutputSink class registered as output_format. ValueError if there is none
+    if output_format not in OUTPUT_SINKS:
+      raise ValueError("unknown output format " + str(output_format) + ", known: " + \
+        ", ".join(sorted(OUTPUT_SINKS)))
+    return OUTPUT_SINKS[output_format]
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def register_sink(name, sink_class):
+    # make an OutputSink subclass available as output_format=name
+    OUTPUT_SINKS[name] = sink_class
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def sink_format(output_format, dest_file):
+    # "text" to a file named like .fen.gz means "compressed". anything else is as given
+    if output_format == "text":
+      for compression in COMPRESSION_OPENERS:
+        if dest_file.endswith("." + compression): return "compressed"
+    return output_format
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def convert_games(games, sink, instr=None, cache=None, selector=None, game_filter=None,
+    error_log=None, source_file=None, first_game=0):
+    # games yields (headers, movetext) like iter_games(). positions go to sink, an open
+    # OutputSink, as FEN strings or what sink.positions asks for, with the game's headers
+    # cache is an optional OpeningCache and selector an optional PlySelector, for FEN sinks
+    # game_filter is an optional GameFilter, see filter_games()
+    # each game is replayed in full before any of it is written, so a game with a move
+    # that raises MoveError is dropped whole and the next game goes on as usual
+    # error_log is an optional ErrorLog that gets a record of each game dropped, games
+    # numbered from first_game as the games of source_file
+    if error_log is not None:
+      games = error_log.number_games(games, source_file, first_game)
+    if game_filter is not None:
+      games = ChessFunctions.filter_games(games, game_filter, instr)
+    for headers, movetext in games:
+      if instr is not None: instr.mark("read")
+      if movetext == "": continue  # tag pairs but no moves
+
+      try:
+        if sink.positions == "records":
+          positions = ChessFunctions.pgn_to_records(movetext, None, instr)
+        elif sink.positions == "keyed":
+          positions = ChessFunctions.pgn_to_fen_keys(movetext, None, instr)
+        elif selector is not None:  # only some positions, no FEN made for the others
+          positions = []
+          for (ply, fen) in ChessFunctions.iter_fen(movetext, selector, None, instr):
+            positions.append(fen)
+        else:
+          # get FEN strings. comments etc. are dropped by the tokenizer
+          positions = ChessFunctions.pgn_to_fen(movetext, None, instr, cache)
+      except MoveError as ex:
+        if error_log is not None: error_log.add_error(ex)
+        if instr is not None: instr.mark("analysis")
+        continue
+      sink.write(positions, headers)
+      if instr is not None: instr.mark("write")
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def file_pgn_to_file_unique_fen(source_pgn_file, dest_fen_file, max_positions=1000000,
+    instr=None, error_log=None):
+    # like file_pgn_to_file_fen() but each distinct position is written once, as a line
+    # "count fen" (count = number of times it occurred, fen = its first occurrence)
+    # positions are keyed by zobrist_key, so move counters do not make positions distinct
+    # and a FEN is only encoded the first time a position is seen
+    # when max_positions are counted in memory, the counts are spilled (between games) to
+    # a sorted run file next to dest_fen_file, and at the end all runs are merged
+    # instr is an optional Instrumentation to collect per-stage timings
+    # each game is replayed in full before it is counted, so a game with a move that
+    # raises MoveError adds nothing. error_log is an optional ErrorLog that gets a record
+    # of each game dropped, like convert_games()
+    if instr is not None: began = instr.begin()
+    counts = {}  # zobrist key -> [count, fen]
+    run_files = []
+    try:
+      games = ChessFunctions.iter_games(source_pgn_file)
+      if error_log is not None:
+        games = error_log.number_games(games, source_pgn_file)
+      for headers, movetext in games:
+        if instr is not None: instr.mark("read")
+        if movetext == "": continue  # tag pairs but no moves
+
+        curr = GameState()
+        keys = []      # zobrist key of each position of the game
+        new_fens = {}  # zobrist key -> fen, for the positions not in counts
+        moves = ChessFunctions.iter_main_line(movetext)
+        try:
+          while True:
+            keys.append(curr.zobrist_key)
+            if curr.zobrist_key not in counts and curr.zobrist_key not in new_fens:
+              new_fens[curr.zobrist_key] = curr.get_fen()
+              if instr is not None: instr.mark("fen")
+            move = next(moves, None)
+            if instr is not None: instr.mark("tokenize")
+            if move is None: break
+            ChessFunctions.make_move(curr, move, instr)
+        except MoveError as ex:
+          if error_log is not None: error_log.add_error(ex)
+          if instr is not None: instr.mark("analysis")
+          continue
+
+        for key in keys:
+          entry = counts.get(key)
+          if entry is None:
+            counts[key] = [1, new_fens[key]]
+          else:
+            entry[0] += 1
+        if instr is not None:
+          instr.games += 1
+          instr.plies += len(keys) - 1  # first position is not a ply
+        if len(counts) >= max_positions:
+          run_file = dest_fen_file + ".run" + str(len(run_files))
+          run_files.append(run_file)
+          ChessFunctions.spill_position_run(counts, run_file)
+          counts = {}
+          if instr is not None: instr.mark("write")
+
+      # k-way merge of the runs and what is still in memory. all are sorted by key, and
+      # for equal keys the earlier run comes first, so the first FEN seen is kept
+      sources = []
+      for i in range(len(run_files)):
+        sources.append(ChessFunctions.iter_position_run(run_files[i], i))
+      in_memory = []
+      for key in sorted(counts):
+        in_memory.append((key, len(run_files), counts[key][0], counts[key][1]))
+      sources.append(in_memory)
+      counts = None
+
+      ofp = ChessFunctions.open_output(dest_fen_file, "w")
+      prev_key = None
+      total = 0
+      first_fen = ""
+      for (key, run_idx, count, fen) in heapq.merge(*sources):
+        if key != prev_key:
+          if prev_key is not None:
+            ofp.write(str(total) + " " + first_fen + "\n")
+          prev_key = key
+          total = 0
+          first_fen = fen
+        total += count
+      if prev_key is not None:
+        ofp.write(str(total) + " " + first_fen + "\n")
+      ofp.close()
+      if instr is not None:
+        instr.mark("write")
+        instr.end(began)
+    finally:
+      for run_file in run_files:
+        if os.path.exists(run_file): os.remove(run_file)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def spill_position_run(counts, run_file):
+    # write counts (zobrist key -> [count, fen]) to run_file sorted by key, one
+    # "key count fen" line per position, key in hex
+    ofp = open(run_file, "w")
+    for key in sorted(counts):
+      entry = counts[key]
+      ofp.write("%016x %d %s\n" % (key, entry[0], entry[1]))
+    ofp.close()
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def iter_position_run(run_file, run_idx):
+    # generator: (key, run_idx, count, fen) for each line of a run file from
+    # spill_position_run(). run_idx breaks ties between runs in the merge
+    ifp = open(run_file, "r")
+    try:
+      for line in ifp:
+        (key, count, fen) = line.rstrip("\n").split(" ", 2)
+        yield (int(key, 16), run_idx, int(count), fen)
+    finally:
+      ifp.close()
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def file_pgn_to_file_fen_parallel(source_pgn_file, dest_fen_file, workers, instr=None,
+    output_format="text", cache=None, selector=None, game_filter=None, error_log=None):
+    # one big PGN file on several cores. the file is memory-mapped to pick split points
+    # at game boundaries, each chunk is converted by a worker process into its own
+    # part file, then the part files are joined in the original game order
+    # output_format must be a sink that can_concatenate. gzip, bz2 and xz part files join
+    # into a valid multi-stream file, so compression also runs in the workers
+    if instr is not None: began = instr.begin()
+    offsets = ChessFunctions.find_game_splits(source_pgn_file, workers * 4)  # extra for balance
+    n_chunks = len(offsets) - 1
+    (root, ext) = os.path.splitext(dest_fen_file)
+    if ext[1:] not in COMPRESSION_OPENERS:
+      (root, ext) = (dest_fen_file, "")
+    part_files = []
+    for i in range(n_chunks):
+      part_files.append(root + ".part" + str(i) + ext)  # keeps .gz etc. for the sink
+
+    try:
+      with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for i in range(n_chunks):
+          chunk_instr = None
+          if instr is not None: chunk_instr = Instrumentation()
+          chunk_cache = None
+          if cache is not None: chunk_cache = cache.empty_copy()
+          chunk_selector = None
+          if selector is not None: chunk_selector = selector.chunk_copy(i)
+          chunk_errors = None
+          if error_log is not None: chunk_errors = ErrorLog()
+          futures.append(pool.submit(ChessFunctions.convert_chunk_job, source_pgn_file,
+            offsets[i], offsets[i+1], part_files[i], chunk_instr, output_format, chunk_cache,
+            chunk_selector, game_filter, chunk_errors))
+        first_game = 0  # number in the file of the chunk's first game
+        for future in futures:
+          (chunk_instr, chunk_cache, chunk_errors) = future.result()  # re-raises worker error
+          if instr is not None: instr.merge(chunk_instr)
+          if cache is not None: cache.merge(chunk_cache)
+          if error_log is not None:
+            error_log.merge(chunk_errors, first_game)
+            first_game += chunk_errors.games
+        if instr is not None: instr.mark(None)  # waiting on workers is not a stage
+
+      temp_file = dest_fen_file + ".tmp"
+      ofp = open(temp_file, "wb")
+      for part_file in part_files:  # stitch back in game order
+        ifp = open(part_file, "rb")
+        shutil.copyfileobj(ifp, ofp, 1024 * 1024)
+        ifp.close()
+      ofp.close()
+      os.replace(temp_file, dest_fen_file)
+      if instr is not None:
+        instr.mark("write")
+        instr.end(began)
+    finally:
+      for part_file in part_files:
+        if os.path.exists(part_file): os.remove(part_file)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def index_pgn_file(source_pgn_file, index_file=None):
+    # build or bring up to date the sidecar game index of source_pgn_file (default name
+    # source_pgn_file + ".idx") and return it as read_game_index() does
+    # when the source has grown since the last call only the new part is scanned, from the
+    # start of the last indexed game (which may have been incomplete). a source that
+    # shrank or changed under the last game is indexed again from the start
+    if index_file is None: index_file = source_pgn_file + ".idx"
+    if ChessFunctions.detect_compression(source_pgn_file) is not None:
+      raise ValueError("cannot index compressed file " + source_pgn_file + \
+        ", its games have no byte offsets")
+    size = os.path.getsize(source_pgn_file)
+    (indexed_size, index) = ChessFunctions.read_game_index_file(index_file)
+    if index is not None and indexed_size == size:
+      return index  # up to date
+
+    scan_from = 0
+    keep = 0  # records of the old index still good
+    if index is not None and indexed_size < size and len(index) > 0:
+      last_offset = int(index[-1]["offset"])
+      ifp = open(source_pgn_file, "rb")
+      ifp.seek(last_offset)
+      first_byte = ifp.read(1)
+      ifp.close()
+      if first_byte == b"[":  # last game still starts where it did
+        scan_from = last_offset
+        keep = len(index) - 1
+    index = None   # release the memmap before the file is changed
+
+    records = []
+    for (offset, length, headers) in ChessFunctions.scan_game_offsets(source_pgn_file,
+      scan_from):
+      records.append(ChessFunctions.game_index_record(offset, length, headers))
+    new = np.array(records, dtype=GAME_INDEX_DTYPE)
+
+    if keep == 0 or os.path.exists(index_file) == False:
+      ofp = open(index_file, "wb")
+    else:
+      ofp = open(index_file, "r+b")
+    ofp.seek(GAME_INDEX_HEADER_SIZE + keep * GAME_INDEX_DTYPE.itemsize)
+    ofp.truncate()
+    ofp.write(new.tobytes())
+    ofp.seek(0)  # header last, so an interrupted update is redone from the old size
+    ofp.write(GAME_INDEX_MAGIC + size.to_bytes(8, "little"))
+    ofp.close()
+    return ChessFunctions.read_game_index_file(index_file)[1]
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def read_game_index(source_pgn_file, index_file=None):
+    # the sidecar game index as a read-only np.memmap of GAME_INDEX_DTYPE records, one per
+    # game in file order, like index[1234]["offset"]. updated first if out of date
+    return ChessFunctions.index_pgn_file(source_pgn_file, index_file)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def read_game_index_file(index_file):
+    # (indexed source size, records) of an index file. (0, None) if there is none or it
+    # is not a game index
+    if os.path.exists(index_file) == False: return (0, None)
+    ifp = open(index_file, "rb")
+    header = ifp.read(GAME_INDEX_HEADER_SIZE)
+    ifp.close()
+    if len(header) < GAME_INDEX_HEADER_SIZE or header[0:8] != GAME_INDEX_MAGIC:
+      return (0, None)
+    indexed_size = int.from_bytes(header[8:16], "little")
+    n = (os.path.getsize(index_file) - GAME_INDEX_HEADER_SIZE) // GAME_INDEX_DTYPE.itemsize
+    if n == 0: return (indexed_size, np.zeros(0, dtype=GAME_INDEX_DTYPE))
+    return (indexed_size, np.memmap(index_file, dtype=GAME_INDEX_DTYPE, mode="r",
+      offset=GAME_INDEX_HEADER_SIZE, shape=(n,)))
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def scan_game_offsets(source_pgn_file, start=0):
+    # generator: (offset, length, headers) of each game in the file from byte start on,
+    # games split like GameSplitter does. headers are the game's tag-pair lines (bytes)
+    # length runs up to the next game, so blank lines after a game are part of it
+    ifp = open(source_pgn_file, "rb")
+    try:
+      ifp.seek(start)
+      pos = start
+      game_start = None
+      headers = []
+      in_movetext = False
+      for line in ifp:
+        if line.startswith(b"["):
+          if in_movetext == True:  # tag-pair boundary so previous game done
+            yield (game_start, pos - game_start, headers)
+            game_start = None
+            headers = []
+            in_movetext = False
+          if game_start is None: game_start = pos
+          headers.append(line)
+        elif line.startswith(b"%") == False and line.strip() != b"":
+          if game_start is None: game_start = pos
+          in_movetext = True
+        pos += len(line)
+      if game_start is not None:  # last game in file
+        yield (game_start, pos - game_start, headers)
+    finally:
+      ifp.close()
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def game_index_record(offset, length, headers):
+    # GAME_INDEX_DTYPE field values for one game, headers are its tag-pair lines (bytes)
+    lines = []
+    for line in headers:
+      lines.append(line.decode("utf-8", "replace").strip())
+    tags = ChessFunctions.parse_tag_pairs(lines)
+    elos = []
+    for tag in ("WhiteElo", "BlackElo"):
+      value = tags.get(tag, "")
+      if value.isdigit() == True and int(value) < 65536: elos.append(int(value))
+      else: elos.append(0)
+    result = 0
+    if tags.get("Result") in GAME_RESULTS: result = GAME_RESULTS.index(tags.get("Result"))
+    date = tags.get("Date", "").encode("ascii", "replace")[0:10]
+    return (offset, length, elos[0], elos[1], result, date)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def file_pgn_games_to_file_fen(source_pgn_file, dest_fen_file, first, count=1,
+    output_format="text", index_file=None, error_log=None):
+    # convert games first, first + 1, . . first + count - 1 (0 = first game in the file)
+    # like file_pgn_to_file_fen(), reading only their bytes: the sidecar index (see
+    # index_pgn_file(), built or updated as needed) gives where they are
+    # error_log is an optional ErrorLog, see file_pgn_to_file_fen()
+    index = ChessFunctions.index_pgn_file(source_pgn_file, index_file)
+    if first < 0 or count < 1 or first + count > len(index):
+      raise IndexError("games " + str(first) + " to " + str(first + count - 1) + \
+        " not in " + source_pgn_file + " (" + str(len(index)) + " games)")
+    last = first + count - 1
+    start = int(index[first]["offset"])
+    end = int(index[last]["offset"]) + int(index[last]["length"])
+    lines = ChessFunctions.iter_file_lines(source_pgn_file, start, end)
+    output_format = ChessFunctions.sink_format(output_format, dest_fen_file)
+    with ChessFunctions.make_sink(output_format, dest_fen_file) as sink:
+      ChessFunctions.convert_games(ChessFunctions.iter_games_from_lines(lines), sink,
+        error_log=error_log, source_file=source_pgn_file, first_game=first)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def read_indexed_game(source_pgn_file, game_number, index_file=None):
+    # (headers, movetext) of one game, like iter_games() yields, by seeking to it
+    index = ChessFunctions.index_pgn_file(source_pgn_file, index_file)
+    if game_number < 0 or game_number >= len(index):
+      raise IndexError("game " + str(game_number) + " not in " + source_pgn_file + \
+        " (" + str(len(index)) + " games)")
+    ifp = open(source_pgn_file, "rb")
+    ifp.seek(int(index[game_number]["offset"]))
+    data = ifp.read(int(index[game_number]["length"]))
+    ifp.close()
+    lines = data.decode("utf-8", "replace").splitlines(True)
+    for game in ChessFunctions.iter_games_from_lines(lines):
+      return game  # there is exactly one
+    return ([], "")
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def indexed_game_to_fen(source_pgn_file, game_number, index_file=None):
+    # pgn_to_fen() of one game of the file, found through the sidecar index
+    (headers, movetext) = ChessFunctions.read_indexed_game(source_pgn_file, game_number,
+      index_file)
+    return ChessFunctions.pgn_to_fen(movetext)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def find_game_splits(source_pgn_file, n_chunks):
+    # byte offsets [0, . . , file size] that cut the file into about n_chunks pieces
+    # each inner offset is the start of a game's first tag-pair line (whatever the tag),
+    # where GameSplitter would start a new game, so no game is cut in two
+    size = os.path.getsize(source_pgn_file)
+    offsets = [0]
+    if size > 0:
+      ifp = open(source_pgn_file, "rb")
+      mm = mmap.mmap(ifp.fileno(), 0, access=mmap.ACCESS_READ)
+      for k in range(1, n_chunks):
+        target = max(size * k // n_chunks, offsets[-1])
+        idx = mm.find(b"\n[", target)
+        while idx >= 0 and ChessFunctions.follows_movetext(mm, idx) == False:
+          idx = mm.find(b"\n[", idx + 1)  # a tag pair after the first of its game
+        if idx < 0: break  # no more games after target
+        if idx + 1 > offsets[-1]:
+          offsets.append(idx + 1)  # just past the newline
+      mm.close()
+      ifp.close()
+    offsets.append(size)
+    return offsets
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def follows_movetext(mm, end):
+    # is the last line of mm before offset end (a newline) that is not blank or a % escape
+    # a movetext line? then a tag-pair line starting at end + 1 begins a new game
+    while end > 0:
+      start = mm.rfind(b"\n", 0, end) + 1  # 0 for the first line of the file
+      line = mm[start:end]
+      if line.strip() != b"" and line.startswith(b"%") == False:
+        return line.startswith(b"[") == False
+      end = start - 1
+    return False
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def convert_chunk_job(source_pgn_file, start, end, part_file, instr=None,
+    output_format="text", cache=None, selector=None, game_filter=None, error_log=None):
+    # one unit of work for file_pgn_to_file_fen_parallel(), run in a worker process:
+    # convert the games in bytes [start, end) of the source file to part_file
+    # returns (instr, cache, error_log), the worker's copies, so the parent can merge the
+    # timings, cache statistics and skipped games. the cached positions are dropped first,
+    # only the numbers go back. error_log numbers games from 0 at start
+    if instr is not None: instr.mark(None)
+    lines = ChessFunctions.iter_file_lines(source_pgn_file, start, end)
+    with ChessFunctions.make_sink(output_format, part_file) as sink:
+      ChessFunctions.convert_games(ChessFunctions.iter_games_from_lines(lines), sink, instr,
+        cache, selector, game_filter, error_log, source_pgn_file)
+    if instr is not None: instr.mark("write")
+    if cache is not None: cache.clear()
+    return (instr, cache, error_log)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def iter_file_lines(source_file, start, end):
+    # generator: text lines of the file that start in bytes [start, end)
+    ifp = open(source_file, "rb")
+    try:
+      ifp.seek(start)
+      pos = start
+      while pos < end:
+        line = ifp.readline()
+        if line == b"": break
+        pos += len(line)
+        yield line.decode("utf-8", "replace")
+    finally:
+      ifp.close()
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def iter_games(source_pgn_file):
+    # generator: yield (headers, movetext) for each game in a PGN file, one game at a time
+    # headers is a list of tag-pair lines like '[Event "Karlsbad"]'
+    # movetext is the raw (uncleaned) move text of the game, newlines included
+    # gzip, bzip2 and xz files are decompressed on the fly by iter_compressed_lines()
+    compression = ChessFunctions.detect_compression(source_pgn_file)
+    if compression is not None:
+      lines = ChessFunctions.iter_compressed_lines(source_pgn_file, compression)
+      for game in ChessFunctions.iter_games_from_lines(lines):
+        yield game
+      return
     ifp = open(source_pgn_file, "r")
-    pgn = ""
-    for line in ifp:
-      if line.startswith("["): continue
-      if line.startswith(" "): continue
-      if line.startswith(";"): continue
-      idx = line.find(";")  # remove to-end-of-line style comments
-      if idx >= 0:
-        line = line[:idx]
-      line = line.strip()  # remove newline
-      line += " "  # for parsing
-      pgn += line
+    try:
+      for game in ChessFunctions.iter_games_from_lines(ifp):
+        yield game
+    finally:
+      ifp.close()
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def detect_compression(source_file):
+    # "gz", "bz2" or "xz" by the magic bytes at the start of the file, or by its extension
+    # if it is too short to tell. None for a plain file
+    ifp = open(source_file, "rb")
+    head = ifp.read(6)
     ifp.close()
+    for (magic, compression) in COMPRESSION_MAGIC:
+      if head.startswith(magic): return compression
+    if len(head) < 6:
+      for compression in COMPRESSION_OPENERS:
+        if source_file.endswith("." + compression): return compression
+    return None
 
-    # remove { xxx } style embedded comments
-    start = pgn.find("{")
-    while start >= 0:
-      end = pgn.find("}")
-      pgn = pgn[:start] + pgn[end+1:]
-      start = pgn.find("{")  # look for next comment
-
-    # remove triple dots
-    pgn = pgn.replace("...", "")  # gets all occurences
-
-    # add space after move numbers if not already there
-    pgn = pgn.replace(".", ". ")
-    # no double spaces allowed
-    while pgn.find("  ") >= 0:
-      pgn = pgn.replace("  ", " ")
-    pgn = pgn.strip()  # final tidy up
-
-    # get FEN strings
-    fen_list = ChessFunctions.pgn_to_fen(pgn)
-
-    # write FEN strings to output file
-    ofp = open(dest_fen_file, "w")
-    for i in range(len(fen_list)):
-      ofp.write(fen_list[i] + "\n")
-    ofp.close()
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def iter_compressed_lines(source_file, compression, chunk_size=1024*1024):
+    # generator: text lines of a compressed file. a background thread decompresses
+    # chunk_size blocks into a small queue while the caller replays games. zlib, bz2 and
+    # lzma release the GIL while they work, so decompression and replay overlap
+    chunks = queue.Queue(8)  # bytes, b"" at the end, or the exception that stopped it
+    stop = threading.Event()
+
+    def produce():
+      try:
+        ifp = COMPRESSION_OPENERS[compression](source_file, "rb")
+        try:
+          while stop.is_set() == False:
+            chunk = ifp.read(chunk_size)
+            chunks.put(chunk)
+            if chunk == b"": break
+        finally:
+          ifp.close()
+      except Exception as ex:
+        chunks.put(ex)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    carry = b""  # part line at the end of the previous chunk
+    try:
+      while True:
+        chunk = chunks.get()
+        if isinstance(chunk, Exception): raise chunk
+        if chunk == b"": break
+        data = carry + chunk
+        cut = data.rfind(b"\n") + 1
+        carry = data[cut:]
+        if cut == 0: continue
+        pieces = data[:cut].decode("utf-8", "replace").split("\n")
+        for i in range(len(pieces) - 1):  # last piece is the empty string after the "\n"
+          yield pieces[i] + "\n"
+      if len(carry) > 0:
+        yield carry.decode("utf-8", "replace")
+    finally:
+      stop.set()  # caller stopped early or error: let the thread finish
+      while thread.is_alive():
+        try:
+          chunks.get_nowait()
+        except queue.Empty:
+          thread.join(0.05)
 
   # -----------------------------------------------------------------------------------------------
 
-  @ staticmethod
-  def files_pgn_to_files_fen(src_dir, dest_dir):
-    # scan thru directory src_dir, fetch all .pgn files, convert to .fen files, save in dest_dir
-    # assumes dest_dir exists
-    for src_file in os.listdir(src_dir):
-      if src_file.endswith(".pgn"):
+  @staticmethod
+  def open_output(dest_file, mode):
+    # open dest_file for writing ("w" or "wb"), compressed if its name ends in .gz .bz2
+    # or .xz
+    for compression in COMPRESSION_OPENERS:
+      if dest_file.endswith("." + compression):
+        if mode == "w": mode = "wt"
+        return COMPRESSION_OPENERS[compression](dest_file, mode)
+    return open(dest_file, mode)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def iter_games_from_lines(lines):
+    # lines is anything that yields text lines: an open file, a list, a socket wrapper . .
+    # see GameSplitter for how lines are grouped into games
+    splitter = GameSplitter()
+    for line in lines:
+      game = splitter.feed(line)
+      if game is not None:
+        yield game
+    game = splitter.finish()
+    if game is not None:  # last game in file
+      yield game
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  async def convert_stream_async(source, sink, executor=None, queue_size=64, error_log=None):
+    # asyncio version of file_pgn_to_file_fen() for pipes and network feeds
+    # source is an asyncio.StreamReader or an async iterator of text (or bytes) lines
+    # sink is an asyncio.StreamWriter, or an async function called with the FEN lines
+    # of each game as one string
+    # three tasks joined by queues of at most queue_size items, so a slow sink holds back
+    # the reader: read (lines to games), convert (pgn_to_fen() of each game submitted to
+    # executor, default the loop's thread pool; a ProcessPoolExecutor uses more cores)
+    # and write (awaits the conversions in game order). the event loop never replays moves
+    # returns the number of games written. an error in any stage cancels the others
+    # except a MoveError: that game is left out and recorded in error_log, an optional
+    # ErrorLog (file None, games numbered from 0 in the stream)
+    loop = asyncio.get_running_loop()
+    games = asyncio.Queue(queue_size)    # (headers, movetext), None at the end
+    pending = asyncio.Queue(queue_size)  # (game number, future of its FEN list) in game
+                                         # order, None at the end
+
+    async def read():
+      splitter = GameSplitter()
+      async for line in ChessFunctions.aiter_lines(source):
+        game = splitter.feed(line)
+        if game is not None: await games.put(game)
+      game = splitter.finish()
+      if game is not None: await games.put(game)
+      await games.put(None)
+
+    async def convert():
+      game_number = -1
+      while True:
+        game = await games.get()
+        if game is None: break
+        game_number += 1
+        (headers, movetext) = game
+        if movetext == "": continue  # tag pairs but no moves
+        await pending.put((game_number, loop.run_in_executor(executor,
+          ChessFunctions.pgn_to_fen, movetext)))
+      if error_log is not None: error_log.games += game_number + 1
+      await pending.put(None)
+
+    async def write():
+      n_games = 0
+      while True:
+        item = await pending.get()
+        if item is None: break
+        (game_number, future) = item
+        try:
+          fen_list = await future
+        except MoveError as ex:
+          if error_log is not None:
+            error_log.source_file = None
+            error_log.game = game_number
+            error_log.add_error(ex)
+          continue
+        text = "\n".join(fen_list) + "\n"
+        if hasattr(sink, "drain"):  # asyncio.StreamWriter
+          sink.write(text.encode("utf-8"))
+          await sink.drain()
+        else:
+          await sink(text)
+        n_games += 1
+      return n_games
+
+    tasks = [asyncio.ensure_future(read()), asyncio.ensure_future(convert()),
+      asyncio.ensure_future(write())]
+    try:
+      results = await asyncio.gather(*tasks)
+    except BaseException:
+      for task in tasks:
+        task.cancel()
+      raise
+    return results[2]
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  async def aiter_lines(source):
+    # async generator: text lines of an asyncio.StreamReader or an async iterator of lines
+    if hasattr(source, "readline"):
+      while True:
+        line = await source.readline()
+        if len(line) == 0: break
+        yield line.decode("utf-8", "replace")
+    else:
+      async for line in source:
+        if isinstance(line, bytes): line = line.decode("utf-8", "replace")
+        yield line
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def parse_tag_pairs(headers):
+    # dict of tag name -> value from tag-pair lines like '[White "Euwe, Max"]', as in the
+    # headers from iter_games(). \" and \\ in values are unescaped. bad lines are skipped
+    tags = {}
+    for line in headers:
+      m = TAG_PAIR_RE.match(line)
+      if m is None: continue
+      value = m.group(2)
+      if "\\" in value: value = re.sub(r"\\(.)", r"\1", value)
+      tags[m.group(1)] = value
+    return tags
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def filter_games(games, game_filter, instr=None):
+    # generator: the (headers, movetext) games of games (like iter_games()) whose tag pairs
+    # game_filter (a GameFilter or a function of the tags dict) accepts. the movetext of
+    # the others is never tokenized
+    for headers, movetext in games:
+      if instr is not None: instr.mark("read")
+      keep = game_filter(ChessFunctions.parse_tag_pairs(headers))
+      if instr is not None: instr.mark("filter")
+      if keep == True:
+        yield headers, movetext
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def tokenize_movetext(movetext):
+    # generator: single pass over movetext, yield (kind, text) tokens like
+    # (TOKEN_MOVE_NUMBER, "12."), (TOKEN_SAN, "Nbxd2"), (TOKEN_COMMENT, "{ book }"), . .
+    # whitespace and stray characters are dropped. castling with zeros becomes O-O
+    for m in MOVETEXT_TOKEN_RE.finditer(movetext):
+      group = m.lastindex
+      if group == 10:  # most common first
+        yield TOKEN_SAN, m.group(10)
+      elif group == 6:
+        yield TOKEN_MOVE_NUMBER, m.group(6)
+      elif group == 1 or group == 2:
+        yield TOKEN_COMMENT, m.group(group)
+      elif group == 3:
+        yield TOKEN_NAG, m.group(3)
+      elif group == 4:
+        yield TOKEN_RESULT, m.group(4)
+      elif group == 5:
+        yield TOKEN_SAN, m.group(5).replace("0", "O")
+      elif group == 7:
+        yield TOKEN_VARIATION_START, "("
+      elif group == 8:
+        yield TOKEN_VARIATION_END, ")"
+      # groups 9 and 11 are ignored
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def iter_main_line(movetext):
+    # generator: the SAN moves of the main line of movetext, in order. moves inside ( )
+    # variations are skipped, and it stops at 1-0 or 0-1 or 1/2-1/2 or *
+    depth = 0
+    for kind, text in ChessFunctions.tokenize_movetext(movetext):
+      if kind == TOKEN_SAN:
+        if depth == 0: yield text
+      elif kind == TOKEN_VARIATION_START:
+        depth += 1
+      elif kind == TOKEN_VARIATION_END:
+        depth -= 1
+      elif kind == TOKEN_RESULT:
+        if depth == 0: return
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def files_pgn_to_files_fen(src_dir, dest_dir, workers=1, instr=None, compression=None,
+    game_filter=None, checkpoint_file=None, error_log=None):
+    # scan thru directory tree src_dir, fetch all .pgn files, convert to .fen files, save in
+    # dest_dir using the same sub-directory layout (sub-directories are created as needed)
+    # .pgn.gz .pgn.bz2 and .pgn.xz files are converted too. compression "gz" "bz2" or "xz"
+    # writes .fen.gz (etc.) files instead of plain .fen
+    # workers > 1 converts that many files at a time in a process pool
+    # a file that fails is reported and skipped, the batch carries on
+    # returns a list of (src_file, error message) for the files that failed
+    # instr is an optional Instrumentation, worker timings are merged into it
+    # game_filter is an optional GameFilter applied to every file
+    # checkpoint_file is an optional journal so an interrupted run can be resumed: run again
+    # with the same arguments and files already done are skipped, and a large plain-text
+    # file that was part done carries on from its last checkpoint (see
+    # convert_file_checkpointed()). a source file changed since is converted again
+    # a game with a move that cannot be played is left out of its file. error_log is an
+    # optional ErrorLog to record which games were, worker records are merged into it
+    if instr is not None: began = instr.begin()
+    journal = {}
+    if checkpoint_file is not None:
+      journal = ChessFunctions.read_checkpoint_journal(checkpoint_file)
+    jobs = []  # (size, src_file, dest_file)
+    for (src_file, size) in ChessFunctions.find_pgn_files(src_dir):
+      rel_path = os.path.relpath(src_file, src_dir)
+      dest_file = os.path.join(dest_dir, rel_path[:rel_path.rfind(".pgn")] + ".fen")
+      if compression is not None: dest_file += "." + compression
+      record = journal.get(src_file)
+      if record is not None and record.get("done") == True and os.path.exists(dest_file) and \
+        record["identity"] == ChessFunctions.checkpoint_identity(src_file, dest_file):
+        print(src_file + "  (done in an earlier run)")
+        continue
+      jobs.append((size, src_file, dest_file))
+    jobs.sort(reverse=True)  # largest files first so no worker is left with a big one at the end
+
+    errors = []
+    if workers <= 1:
+      for (size, src_file, dest_file) in jobs:
         print(src_file)
-        dest_file = src_file.replace(".pgn", ".fen")
-        ChessFunctions.file_pgn_to_file_fen(src_dir + "\\" + \
-          src_file, dest_dir + "\\" + dest_file)
+        (src_file, msg, job_instr, job_errors) = ChessFunctions.convert_file_job(src_file,
+          dest_file, instr, game_filter, checkpoint_file, journal.get(src_file), error_log)
+        if msg is not None:
+          print("  error: " + msg)
+          errors.append((src_file, msg))
+    else:
+      with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for (size, src_file, dest_file) in jobs:
+          job_instr = None
+          if instr is not None: job_instr = Instrumentation()
+          job_errors = None
+          if error_log is not None: job_errors = ErrorLog()
+          futures.append(pool.submit(ChessFunctions.convert_file_job, src_file, dest_file,
+            job_instr, game_filter, checkpoint_file, journal.get(src_file), job_errors))
+        for future in as_completed(futures):
+          (src_file, msg, job_instr, job_errors) = future.result()
+          if instr is not None: instr.merge(job_instr)
+          if error_log is not None: error_log.merge(job_errors)
+          print(src_file)
+          if msg is not None:
+            print("  error: " + msg)
+            errors.append((src_file, msg))
+    if instr is not None: instr.end(began)
+    return errors
 
   # -----------------------------------------------------------------------------------------------
 
   @staticmethod
-  def pgn_to_fen(pgn):
-    # pgn is one big clean PGN string like 1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Bxf6 1-0
-    # pgn ends with 1-0 or 0-1 or 1/2-1/2 or *
-    # pgn string cannot have { } style comments or 17... Nf6 style black moves
+  def convert_file_checkpointed(src_file, dest_file, checkpoint_file, resume=None,
+    instr=None, game_filter=None, error_log=None):
+    # file_pgn_to_file_fen() of one file, journaled in checkpoint_file
+    # every CHECKPOINT_INTERVAL bytes of source the output so far is flushed and synced and
+    # a progress record is appended: where the next game starts in the source and how long
+    # the output .tmp is at that point. resume is the last record of an earlier run, so
+    # that run's .tmp is cut back to the recorded length and conversion goes on from the
+    # recorded game: nothing is written twice and nothing is lost. a "done" record is
+    # appended when dest_file is complete
+    # progress records need a plain source and a sink that can_resume, otherwise an
+    # interrupted file is converted again from the start
+    # error_log is an optional ErrorLog, see file_pgn_to_file_fen()
+    identity = ChessFunctions.checkpoint_identity(src_file, dest_file)
+    sink = ChessFunctions.make_sink(ChessFunctions.sink_format("text", dest_file), dest_file)
+    resumable = sink.can_resume == True and ChessFunctions.detect_compression(src_file) is None
+    offset = 0
+    n_games = 0  # games of the file before offset
+    if resumable == True and resume is not None and resume.get("done") == False and \
+      resume["identity"] == identity and os.path.exists(sink.temp_file) and \
+      os.path.getsize(sink.temp_file) >= resume["output_size"]:
+      sink.reopen(resume["output_size"])
+      offset = resume["offset"]
+      n_games = resume.get("games", 0)
+    else:
+      sink.open()
+
+    try:
+      last_checkpoint = offset
+      if resumable == True:
+        games = ChessFunctions.iter_games_with_offsets(src_file, offset)
+      else:
+        games = ((headers, movetext, None) for (headers, movetext) in
+          ChessFunctions.iter_games(src_file))
+      for (headers, movetext, next_offset) in games:
+        ChessFunctions.convert_games([(headers, movetext)], sink, instr, None, None,
+          game_filter, error_log, src_file, n_games)
+        n_games += 1
+        if resumable == True and next_offset - last_checkpoint >= CHECKPOINT_INTERVAL:
+          ChessFunctions.append_checkpoint(checkpoint_file, { "file": src_file,
+            "identity": identity, "done": False, "offset": next_offset, "games": n_games,
+            "output_size": sink.output_size() })
+          last_checkpoint = next_offset
+    except BaseException:
+      if resumable == True:
+        sink.detach()  # keep the .tmp, the journal says how much of it is good
+      else:
+        sink.abort()
+      raise
+    sink.close()
+    ChessFunctions.append_checkpoint(checkpoint_file, { "file": src_file,
+      "identity": identity, "done": True })
 
-    # checking anyway . . .
-    pgn = pgn.replace(".", ". ")  # move numbers might have space after . or not
-    pgn = pgn.replace("  ", " ")   # but double spaces not allowed
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def iter_games_with_offsets(source_pgn_file, start=0):
+    # generator: (headers, movetext, next_offset) for each game of a plain PGN file from
+    # byte start on. next_offset is where the game after it starts (the file size for the
+    # last), a place to start again from
+    ifp = open(source_pgn_file, "rb")
+    try:
+      ifp.seek(start)
+      pos = start
+      splitter = GameSplitter()
+      for line in ifp:
+        game = splitter.feed(line.decode("utf-8", "replace"))
+        if game is not None:
+          yield (game[0], game[1], pos)  # line at pos starts the next game
+        pos += len(line)
+      game = splitter.finish()
+      if game is not None:
+        yield (game[0], game[1], pos)
+    finally:
+      ifp.close()
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def checkpoint_identity(src_file, dest_file):
+    # what must match for a journal record to apply: the source file unchanged (size and
+    # modification time) and the same destination
+    st = os.stat(src_file)
+    return [st.st_size, st.st_mtime_ns, os.path.abspath(dest_file)]
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def read_checkpoint_journal(checkpoint_file):
+    # dict of source file -> its last record in the journal. a missing journal is empty,
+    # and a last line cut short by a crash is ignored
+    journal = {}
+    if os.path.exists(checkpoint_file) == False: return journal
+    ifp = open(checkpoint_file, "r")
+    for line in ifp:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      journal[record["file"]] = record
+    ifp.close()
+    return journal
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def append_checkpoint(checkpoint_file, record):
+    # add one JSON line to the journal, synced to disk. a single O_APPEND write, so worker
+    # processes can share the journal
+    fd = os.open(checkpoint_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, (json.dumps(record) + "\n").encode("utf-8"))
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def find_pgn_files(src_dir):
+    # generator: (path, size in bytes) of every PGN_SUFFIXES file in the src_dir tree,
+    # recursively
+    with os.scandir(src_dir) as entries:
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          for found in ChessFunctions.find_pgn_files(entry.path):
+            yield found
+        elif entry.is_file() and entry.name.endswith(PGN_SUFFIXES):
+          yield entry.path, entry.stat().st_size
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def convert_file_job(src_file, dest_file, instr=None, game_filter=None,
+    checkpoint_file=None, resume=None, error_log=None):
+    # one unit of work for files_pgn_to_files_fen(), run in a worker process when parallel
+    # returns (src_file, None, instr, error_log) on success or (src_file, error message,
+    # instr, error_log). never raises. instr and error_log are handed back so a worker's
+    # timings and skipped games reach the parent
+    # with a checkpoint_file the conversion is journaled, resume is the file's last
+    # journal record from an earlier run, or None
+    try:
+      dest_sub_dir = os.path.dirname(dest_file)
+      if dest_sub_dir != "":
+        os.makedirs(dest_sub_dir, exist_ok=True)
+      if checkpoint_file is not None:
+        ChessFunctions.convert_file_checkpointed(src_file, dest_file, checkpoint_file, resume,
+          instr, game_filter, error_log)
+      else:
+        ChessFunctions.file_pgn_to_file_fen(src_file, dest_file, 1, instr,
+          game_filter=game_filter, error_log=error_log)
+      return (src_file, None, instr, error_log)
+    except Exception as ex:
+      return (src_file, type(ex).__name__ + ": " + str(ex), instr, error_log)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def pgn_to_fen(pgn, start_state=None, instr=None, cache=None):
+    # pgn is the movetext of one game like 1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Bxf6 1-0
+    # it can be raw, as yielded by iter_games(): { } and ; comments, 17... Nf6 style
+    # black moves, NAGs and ( ) variations are all skipped by tokenize_movetext()
+    # stops at 1-0 or 0-1 or 1/2-1/2 or *
+    # start_state is the position before the first move, a GameState or a
+    # BitboardGameState (not changed). None means the standard starting position
+    # instr is an optional Instrumentation to collect per-stage timings
+    # cache is an optional OpeningCache, used when start_state is None
+
+    if cache is not None and start_state is None:
+      return ChessFunctions.pgn_to_fen_cached(pgn, cache, instr)
 
     results = []
+    if instr is not None: began = instr.begin()
 
-    curr = GameState()
+    if start_state is None:
+      curr = GameState()
+    else:
+      curr = ChessFunctions.copy_of(start_state)
+    if instr is not None: instr.mark("copy")
     results.append(curr.get_fen())  # initial position
+    if instr is not None: instr.mark("fen")
+
+    # the whole game is replayed on the one state object, in place
+    depth = 0  # variation nesting depth. only depth 0 moves are played
+    for kind, text in ChessFunctions.tokenize_movetext(pgn):
+      if kind == TOKEN_SAN:
+        if depth > 0: continue
+        if instr is not None: instr.mark("tokenize")
+        ChessFunctions.make_move(curr, text, instr)
+        results.append(curr.get_fen())
+        if instr is not None: instr.mark("fen")
+      elif kind == TOKEN_VARIATION_START:
+        depth += 1
+      elif kind == TOKEN_VARIATION_END:
+        depth -= 1
+      elif kind == TOKEN_RESULT:
+        if depth == 0: break  # end of game
+    if instr is not None:
+      instr.mark("tokenize")
+      instr.games += 1
+      instr.plies += len(results) - 1
+      instr.end(began)
+    return results
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def iter_fen(pgn, selector=None, start_state=None, instr=None):
+    # generator: lazy pgn_to_fen(). yields (ply, fen) pairs, ply 0 is the position before
+    # the first move, for the positions selector (a PlySelector) picks. None picks all
+    # every move is still played, but no FEN is made for positions not picked
+    # see pgn_to_fen() for start_state. instr is an optional Instrumentation
+    if selector is None: selector = PlySelector()
+    if start_state is None:
+      curr = GameState()
+    else:
+      curr = ChessFunctions.copy_of(start_state)
+    if instr is not None: instr.mark("copy")
+    selector.start()
+    ply = 0
+    pairs = selector.offer(ply, curr)
+    for move in ChessFunctions.iter_main_line(pgn):
+      if instr is not None: instr.mark("fen")
+      for pair in pairs:
+        yield pair
+      if instr is not None: instr.mark(None)  # time in the caller is not a stage
+      ChessFunctions.make_move(curr, move, instr)
+      ply += 1
+      pairs = selector.offer(ply, curr)
+    pairs = pairs + selector.finish(ply, curr)
+    if instr is not None:
+      instr.mark("fen")
+      instr.games += 1
+      instr.plies += ply
+    for pair in pairs:
+      yield pair
+
+  # -----------------------------------------------------------------------------------------------
 
-    tokens = pgn.split(" ")  # like "e4", "e5", "Nf6", . . 
-    for i in range(len(tokens)):
-      if tokens[i][0] == "0" or tokens[i][0] == "1" or tokens[i][0] == "2" or \
-        tokens[i][0] == "3" or tokens[i][0] == "4" or tokens[i][0] == "5" or \
-        tokens[i][0] == "6" or tokens[i][0] == "7" or tokens[i][0] == "8" or \
-        tokens[i][0] == "9":  # move number
-        continue;
-      if tokens[i] == "*": break  # special incomplete game
-
-      move = tokens[i].strip()
-      next = ChessFunctions.update_game_state(curr, move)
-      fen = next.get_fen()
-      results.append(fen)
-      curr = ChessFunctions.copy_of(next)
+  @staticmethod
+  def pgn_to_fen_keys(pgn, start_state=None, instr=None):
+    # like pgn_to_fen() but a list of (fen, zobrist_key) pairs, one per position
+    if start_state is None:
+      curr = GameState()
+    else:
+      curr = ChessFunctions.copy_of(start_state)
+    if instr is not None: instr.mark("copy")
+    results = [(curr.get_fen(), curr.zobrist_key)]
+    for move in ChessFunctions.iter_main_line(pgn):
+      if instr is not None: instr.mark("tokenize")
+      ChessFunctions.make_move(curr, move, instr)
+      results.append((curr.get_fen(), curr.zobrist_key))
+      if instr is not None: instr.mark("fen")
+    if instr is not None:
+      instr.games += 1
+      instr.plies += len(results) - 1
+    return results
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def pgn_to_fen_cached(pgn, cache, instr=None):
+    # pgn_to_fen() from the standard starting position, resuming from the longest prefix
+    # of the game's moves found in cache (an OpeningCache) and adding the positions after
+    # it, up to cache.max_plies, for later games
+    if instr is not None: began = instr.begin()
+    node = cache.root
+    path = []     # cache nodes of this game, shallowest first
+    curr = None   # GameState being played on, once off the cached prefix
+    results = [node.fen]
+    for move in ChessFunctions.iter_main_line(pgn):
+      if curr is None:
+        child = node.children.get(move)
+        if child is not None:
+          node = child
+          cache.touch(node)
+          path.append(node)
+          results.append(node.fen)
+          continue
+        curr = ChessFunctions.copy_of(node.state)  # first move off the cached prefix
+        if len(path) > 0: cache.hits += 1
+        cache.plies_reused += len(path)
+        if instr is not None: instr.mark("cache")
+      ChessFunctions.make_move(curr, move, instr)
+      results.append(curr.get_fen())
+      if instr is not None: instr.mark("fen")
+      if node is not None and len(results) - 1 <= cache.max_plies:
+        node = cache.add(node, move, ChessFunctions.copy_of(curr), results[-1])
+        if node is not None: path.append(node)
+        if instr is not None: instr.mark("cache")
+      else:
+        node = None  # deeper than the cache goes
+    if curr is None:  # whole game was cached
+      if len(path) > 0: cache.hits += 1
+      cache.plies_reused += len(path)
+    for i in range(len(path) - 1, -1, -1):
+      if path[i].alive == True: cache.touch(path[i])  # ancestors most recent
+    cache.games += 1
+    cache.plies += len(results) - 1
+    if instr is not None:
+      instr.mark("cache")
+      instr.games += 1
+      instr.plies += len(results) - 1
+      instr.end(began)
     return results
 
   # -----------------------------------------------------------------------------------------------
 
+  @staticmethod
+  def pgn_to_records(pgn, start_state=None, instr=None):
+    # like pgn_to_fen() but returns a numpy array of POSITION_DTYPE records, one per
+    # position, instead of FEN strings. packing is done for the whole game at once
+    if instr is not None: began = instr.begin()
+    (codes, fields) = ChessFunctions.replay_boards(pgn, start_state, instr)
+    n = len(codes)
+    records = np.zeros(n, dtype=POSITION_DTYPE)
+    records["board"] = codes[:, 0::2] | (codes[:, 1::2] << 4)
+    columns = list(zip(*fields))
+    records["white_to_move"] = columns[0]
+    records["castling"] = columns[1]
+    records["ep_file"] = columns[2]
+    records["fifty_move_ctr"] = columns[3]
+    records["full_move_ctr"] = columns[4]
+    if instr is not None:
+      instr.mark("encode")
+      instr.games += 1
+      instr.plies += n - 1
+      instr.end(began)
+    return records
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def replay_boards(pgn, start_state=None, instr=None):
+    # replay the main line of pgn (see pgn_to_fen() for start_state) without making FEN text
+    # returns (codes, fields): codes is an (N, 64) uint8 array, the POSITION_PIECE_CODES
+    # code of each square of each of the N positions, and fields is a list of N tuples
+    # (white_to_move, castling mask, ep_file, fifty_move_ctr, full_move_ctr)
+    # each ply only saves the 64 board characters, the conversion is one vectorized step
+    if start_state is None:
+      curr = GameState()
+    else:
+      curr = ChessFunctions.copy_of(start_state)
+    bitboard = isinstance(curr, BitboardGameState)
+    boards = []
+    fields = []
+    if instr is not None: instr.mark("copy")
+
+    moves = ChessFunctions.iter_main_line(pgn)
+    while True:
+      if bitboard == True:
+        boards.append("".join([curr.board_position[i] for i in range(64)]))
+      else:
+        boards.append("".join(curr.board_position))
+      ep_file = NO_EP_FILE
+      if curr.ep_square != "-": ep_file = ord(curr.ep_square[0]) - ord("a")
+      fields.append((curr.color_to_move == "w", CASTLING_MASKS[curr.castling_info], ep_file,
+        curr.fifty_move_ctr, curr.full_move_ctr))
+      if instr is not None: instr.mark("encode")
+      move = next(moves, None)
+      if instr is not None: instr.mark("tokenize")
+      if move is None: break
+      ChessFunctions.make_move(curr, move, instr)
+
+    codes = np.frombuffer("".join(boards).translate(POSITION_CODE_TABLE).encode("latin-1"),
+      dtype=np.uint8).reshape(len(boards), 64)
+    return (codes, fields)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def pgn_to_planes(pgn, start_state=None, instr=None):
+    # positions of pgn as neural net input, see pgn_to_fen() for start_state
+    # returns (planes, side, castling) for the N positions:
+    # planes (N, 12, 8, 8) uint8, plane i is 1 where piece BitboardGameState.PIECES[i] is,
+    # row 0 = rank 8 and column 0 = file a like board_position
+    # side (N,) uint8, 1 = white to move
+    # castling (N, 4) uint8, columns K Q k q, 1 = privilege still held
+    if instr is not None: began = instr.begin()
+    (codes, fields) = ChessFunctions.replay_boards(pgn, start_state, instr)
+    n = len(codes)
+    planes = (codes[:, None, :] == PLANE_CODES[None, :, None]).view(np.uint8)
+    planes = planes.reshape(n, 12, 8, 8)
+    columns = np.array([(f[0], f[1]) for f in fields], dtype=np.uint8).reshape(n, 2)
+    side = columns[:, 0].copy()
+    castling = ((columns[:, 1:2] & CASTLING_BITS[None, :]) != 0).view(np.uint8)
+    if instr is not None:
+      instr.mark("encode")
+      instr.games += 1
+      instr.plies += n - 1
+      instr.end(began)
+    return (planes, side, castling)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def file_pgn_to_file_planes(source_pgn_file, dest_prefix, shard_size=100000, instr=None,
+    use_memmap=False, error_log=None):
+    # pgn_to_planes() for every game in the file, written in shards of shard_size positions
+    # shard k is three .npy files: dest_prefix.k.planes.npy, .side.npy and .castling.npy
+    # (k is 5 digits, the last shard is shorter). use_memmap=True fills each shard through
+    # np.memmap directly in its file instead of in memory and then np.save()
+    # returns the number of shards. read them back with read_plane_shards()
+    # a game with a move that cannot be played is left out, and recorded in error_log if
+    # there is one (an ErrorLog)
+    if instr is not None: began = instr.begin()
+    shapes = { "planes": (12, 8, 8), "side": (), "castling": (4,) }
+    n_shards = 0
+    shard = None  # name -> array of shard_size rows
+    filled = 0
+    games = ChessFunctions.iter_games(source_pgn_file)
+    if error_log is not None:
+      games = error_log.number_games(games, source_pgn_file)
+    for headers, movetext in games:
+      if instr is not None: instr.mark("read")
+      if movetext == "": continue  # tag pairs but no moves
+      try:
+        arrays = ChessFunctions.pgn_to_planes(movetext, None, instr)
+      except MoveError as ex:
+        if error_log is not None: error_log.add_error(ex)
+        continue
+      done = 0  # rows of this game copied so far
+      while done < len(arrays[0]):
+        if shard is None:
+          shard = {}
+          for name in shapes:
+            path = dest_prefix + ".%05d." % n_shards + name + ".npy"
+            if use_memmap == True:
+              shard[name] = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8,
+                shape=(shard_size,) + shapes[name])
+            else:
+              shard[name] = np.zeros((shard_size,) + shapes[name], dtype=np.uint8)
+          n_shards += 1
+          filled = 0
+        k = min(shard_size - filled, len(arrays[0]) - done)
+        shard["planes"][filled:filled+k] = arrays[0][done:done+k]
+        shard["side"][filled:filled+k] = arrays[1][done:done+k]
+        shard["castling"][filled:filled+k] = arrays[2][done:done+k]
+        filled += k
+        done += k
+        if filled == shard_size:
+          ChessFunctions.save_plane_shard(dest_prefix, n_shards - 1, shard, filled)
+          shard = None
+      if instr is not None: instr.mark("write")
+    if shard is not None:
+      ChessFunctions.save_plane_shard(dest_prefix, n_shards - 1, shard, filled)
+    if instr is not None:
+      instr.mark("write")
+      instr.end(began)
+    return n_shards
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def save_plane_shard(dest_prefix, shard_idx, shard, filled):
+    # write the first filled rows of each array of a file_pgn_to_file_planes() shard
+    for name in shard:
+      path = dest_prefix + ".%05d." % shard_idx + name + ".npy"
+      arr = shard[name]
+      if isinstance(arr, np.memmap):
+        if filled == len(arr):
+          arr.flush()
+          continue
+        rows = np.array(arr[:filled])  # short last shard: copy out, then rewrite smaller
+        del arr
+        shard[name] = None
+        np.save(path, rows)
+      else:
+        np.save(path, arr[:filled])
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def read_plane_shards(dest_prefix, mmap=True):
+    # generator: (planes, side, castling) for each shard written by file_pgn_to_file_planes(),
+    # in order. with mmap=True the arrays are memory-mapped, read from disk as used
+    mmap_mode = None
+    if mmap == True: mmap_mode = "r"
+    k = 0
+    while os.path.exists(dest_prefix + ".%05d.planes.npy" % k):
+      arrays = []
+      for name in ["planes", "side", "castling"]:
+        arrays.append(np.load(dest_prefix + ".%05d." % k + name + ".npy", mmap_mode=mmap_mode))
+      yield tuple(arrays)
+      k += 1
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def read_position_file(source_file):
+    # records written with output_format="binary", as a read-only numpy array of
+    # POSITION_DTYPE backed by np.memmap: records[i] is read from disk, nothing parsed
+    if os.path.getsize(source_file) == 0:
+      return np.zeros(0, dtype=POSITION_DTYPE)  # memmap cannot map an empty file
+    return np.memmap(source_file, dtype=POSITION_DTYPE, mode="r")
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def position_record_to_fen(record):
+    # FEN string of one POSITION_DTYPE record, like read_position_file(f)[i]
+    packed = record["board"]
+    board = []
+    for i in range(32):
+      board.append(POSITION_PIECE_CODES[packed[i] & 0x0F])
+      board.append(POSITION_PIECE_CODES[packed[i] >> 4])
+    color_to_move = "b"
+    if record["white_to_move"] == 1: color_to_move = "w"
+    castling_info = "-"
+    mask = int(record["castling"])
+    for info in CASTLING_MASKS:
+      if CASTLING_MASKS[info] == mask: castling_info = info
+    ep_square = "-"
+    if record["ep_file"] != NO_EP_FILE:
+      ep_square = "abcdefgh"[record["ep_file"]]
+      if color_to_move == "w": ep_square += "6"  # black just moved a pawn 2 squares
+      else: ep_square += "3"
+    return ChessFunctions.board_position_to_fen(board) + " " + color_to_move + " " + \
+      castling_info + " " + ep_square + " " + str(int(record["fifty_move_ctr"])) + " " + \
+      str(int(record["full_move_ctr"]))
+
+  # -----------------------------------------------------------------------------------------------
+
   @staticmethod
   def update_game_state(curr_state, move):
-    # 
+    # new GameState after move. curr_state is not changed
     next_state = ChessFunctions.copy_of(curr_state)
-    mar = ChessFunctions.move_analysis(move, curr_state)  # all info needed to update
+    ChessFunctions.make_move(next_state, move)
+    return next_state
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def make_move(state, move, instr=None):
+    # play move on state in place. returns a compact undo record for unmake_move():
+    # ((square, old piece), . .), color_to_move, castling_info, ep_square,
+    # fifty_move_ctr, full_move_ctr, zobrist_key -- all as they were before the move
+    # move_analysis() finds the squares of the SAN move, play_move() plays them
+    # instr is an optional Instrumentation, charged "analysis" and "update"
+    # raises MoveError, with state unchanged, if move cannot be played
+    try:
+      mar = ChessFunctions.move_analysis(move, state)  # all info needed to update
+    except MoveError:
+      raise
+    except (IndexError, ValueError) as ex:  # SAN too garbled for move_analysis()
+      raise MoveError(move, state, "malformed move") from ex
+    if mar.came_from_square < 0 or mar.came_from_square > 63 or \
+      state.board_position[mar.came_from_square] != mar.piece_moved:
+      # like a pawn "capture" from the landing file, or a pawn move with no pawn behind
+      raise MoveError(move, state, "no piece can make the move")
+    target = state.board_position[mar.landing_square]
+    if target != "1" and target.isupper() == mar.piece_moved.isupper():
+      raise MoveError(move, state, "landing square holds own piece")
+    if mar.pawn_moved == True and mar.capture == False and target != "1":
+      raise MoveError(move, state, "pawn blocked")  # pawns only capture diagonally
+    if mar.pawn_moved == True and mar.capture == True and target == "1" and \
+      state.ep_square != ChessFunctions.square_int_to_algebraic(mar.landing_square):
+      raise MoveError(move, state, "nothing to capture")
+    if instr is not None: instr.mark("analysis")
+
+    promotion = None
+    if mar.landing_piece != mar.piece_moved: promotion = mar.landing_piece
+    undo = ChessFunctions.play_move(state,
+      (mar.came_from_square, mar.landing_square, promotion))
+    if instr is not None: instr.mark("update")
+    return undo
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def play_move(state, move):
+    # play move, a (came_from_square, landing_square, promotion) tuple as legal_moves()
+    # gives, on state in place, and return the undo record of make_move(). no legality
+    # test. a king moving two squares castles, and a pawn moving diagonally to an empty
+    # square captures e.p., taking the pawn beside it
+    (came_from_square, landing_square, promotion) = move
+    board = state.board_position
+    piece = board[came_from_square]
+    capture = board[landing_square] != "1"
+    landing_piece = piece
+    if promotion is not None: landing_piece = promotion
+    changes = [(landing_square, landing_piece), (came_from_square, "1")]
+    pawn_moved = piece == "P" or piece == "p"
+    ep_square = "-"
+    if pawn_moved == True:
+      step = landing_square - came_from_square
+      if step == 16 or step == -16:  # 2-step, e.p. square is the one passed over
+        # the older, more common FEN definition: recorded whether or not a capture is
+        # possible
+        ep_square = ChessFunctions.square_int_to_algebraic(came_from_square + step // 2)
+      elif capture == False and step % 8 != 0:  # e.p., captured pawn is beside came-from
+        changes.append(((came_from_square // 8) * 8 + landing_square % 8, "1"))
+        capture = True
+    elif (piece == "K" or piece == "k") and (landing_square - came_from_square == 2 or \
+      came_from_square - landing_square == 2):
+      (rook_from, rook_to) = CASTLING_ROOK_MOVES[landing_square]
+      changes.append((rook_to, board[rook_from]))
+      changes.append((rook_from, "1"))
+
     # GameState:
     # 1. board_position # not in FEN format 
     # 2. color_to_move # "w" or "b"
@@ -221,78 +2656,69 @@ class ChessFunctions:
     # 6. full_move_ctr
 
     # 1. update the board
-    # special case of O-O and O-O-O. could have + or # appended
-    # move_analysis() results not needed
-    if move.find("O-O-O") >= 0 and curr_state.color_to_move == "w":
-      next_state.board_position[58] = "K"
-      next_state.board_position[59] = "R"
-      next_state.board_position[56] = "1" # empty
-      next_state.board_position[57] = "1"
-      next_state.board_position[60] = "1"
-    elif move.find("O-O") >= 0 and curr_state.color_to_move == "w":
-      # checking this second -- would be caught by "O-O-O"
-      next_state.board_position[62] = "K"
-      next_state.board_position[61] = "R"
-      next_state.board_position[60] = "1" # empty
-      next_state.board_position[63] = "1"
-    elif move.find("O-O-O") >= 0 and curr_state.color_to_move == "b":
-      next_state.board_position[2] = "k"
-      next_state.board_position[3] = "r"
-      next_state.board_position[0] = "1" # empty
-      next_state.board_position[1] = "1"
-      next_state.board_position[4] = "1"
-    elif move.find("O-O") >= 0 and curr_state.color_to_move == "b":
-      next_state.board_position[6] = "k"
-      next_state.board_position[5] = "r"
-      next_state.board_position[4] = "1" # empty
-      next_state.board_position[7] = "1"
-    else:  # any move other than castles
-      next_state.board_position[mar.landing_square] = mar.landing_piece
-      next_state.board_position[mar.came_from_square] = "1"  # empty square code
+    old_key = state.zobrist_key
+    old_squares = []
+    for (square, new_piece) in changes:
+      old_squares.append((square, board[square]))
+      state.set_square(square, new_piece)
+    undo = (tuple(old_squares), state.color_to_move, state.castling_info, state.ep_square,
+      state.fifty_move_ctr, state.full_move_ctr, old_key)
+    # set_square() has already updated the key for the pieces. the rest is done here
+    key = state.zobrist_key ^ ZOBRIST_BLACK_TO_MOVE  # side to move always flips
+    key ^= ChessFunctions.zobrist_castling_ep(state.castling_info, state.ep_square)
+
+    # 6. update full-move counter (first, needs color before the move)
+    if state.color_to_move == "b":
+      state.full_move_ctr += 1
 
     # 2. update player/color to move
-    if curr_state.color_to_move == "w":
-      next_state.color_to_move = "b"
-    elif curr_state.color_to_move == "b":
-        next_state.color_to_move = "w"
-
-    # 3. update castling privilege info from KQkq to whatever
-    if curr_state.castling_info == "-":
-      next_state.castling_info = "-" # once privileges lost, never return
-    else:
-      new_info = ""
-      for i in range(len(curr_state.castling_info)):  # 15 combinations
-        symbol = curr_state.castling_info[i]  # like K or q
-        if symbol == "K" and mar.white_kingside_castle_invalid == False: # ugly
-          new_info += "K"  # king side castling still valid
-        elif symbol == "Q" and mar.white_queenside_castle_invalid == False:
-          new_info += "Q"
-        elif symbol == "k" and mar.black_kingside_castle_invalid == False:
-          new_info += "k"
-        elif symbol == "q" and mar.black_queenside_castle_invalid == False:
-          new_info += "q"
-      
-      if new_info == "":
-        next_state.castling_info = "-"
-      else:
-        next_state.castling_info = new_info
+    if state.color_to_move == "w":
+      state.color_to_move = "b"
+    elif state.color_to_move == "b":
+      state.color_to_move = "w"
+
+    # 3. update castling privilege info from KQkq to whatever. a move from or to a king or
+    # rook home square ends the privileges that need that piece there
+    if state.castling_info != "-": # once privileges lost, never return
+      lost = CASTLING_LOST.get(came_from_square, "") + CASTLING_LOST.get(landing_square, "")
+      if lost != "":
+        new_info = ""
+        for symbol in state.castling_info:
+          if lost.find(symbol) < 0: new_info += symbol
+        if new_info == "":
+          state.castling_info = "-"
+        else:
+          state.castling_info = new_info
+
+    # 4. update the e.p. square
+    state.ep_square = ep_square
 
-    # 4. update the e.p. square (using FEN spec loose definition)
-    next_state.ep_square = mar.ep_square
+    key ^= ChessFunctions.zobrist_castling_ep(state.castling_info, state.ep_square)
+    state.zobrist_key = key
 
     # 5. update 50-move counter (half-move clock)
-    if mar.pawn_moved == True or mar.capture == True:
-      next_state.fifty_move_ctr = 0
-    elif mar.pawn_moved == False and mar.capture == False:
-      next_state.fifty_move_ctr = curr_state.fifty_move_ctr + 1
-
-    # 6. update full-move counter
-    if curr_state.color_to_move == "b":
-      next_state.full_move_ctr = curr_state.full_move_ctr + 1
+    if pawn_moved == True or capture == True:
+      state.fifty_move_ctr = 0
     else:
-      next_state.full_move_ctr = curr_state.full_move_ctr
+      state.fifty_move_ctr += 1
+    return undo
 
-    return next_state
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def unmake_move(state, undo):
+    # take back the move that make_move() returned undo for. state is changed in place
+    (old_squares, color_to_move, castling_info, ep_square, fifty_move_ctr, full_move_ctr,
+      zobrist_key) = undo
+    for i in range(len(old_squares) - 1, -1, -1):
+      (square, piece) = old_squares[i]
+      state.set_square(square, piece)
+    state.color_to_move = color_to_move
+    state.castling_info = castling_info
+    state.ep_square = ep_square
+    state.fifty_move_ctr = fifty_move_ctr
+    state.full_move_ctr = full_move_ctr
+    state.zobrist_key = zobrist_key
  
   # -----------------------------------------------------------------------------------------------
 
@@ -327,7 +2753,10 @@ class ChessFunctions:
   @staticmethod
   def move_analysis(move, gs):
     # get all info needed to update curr GameState gs
+    # raises MoveError for a move that cannot be resolved. SAN too garbled to parse may
+    # also raise IndexError or ValueError, which make_move() turns into a MoveError
 
+    san = move  # as written, for errors
     results = MoveAnalysisResults()
     # fill in with dummy values to find logic errors
     results.piece_moved = "J"
@@ -357,6 +2786,14 @@ class ChessFunctions:
     else:
       results.capture = False
 
+    # castling written as the king's move, like Ke1g1, is played as O-O so it gets the same
+    # tests (privilege, empty path, not through check)
+    if len(move) == 5 and move[0] == "K" and results.capture == False:
+      right = CASTLING_KING_MOVES.get(move[1:])
+      if right is not None and (right == "K" or right == "Q") == (gs.color_to_move == "w"):
+        move = "O-O"
+        if right == "Q" or right == "q": move = "O-O-O"
+
     # ------------------------------------------------------------------------------------------
 
     # logic for non-pawns. (pawn moves and castling need separate logic)
@@ -386,8 +2823,6 @@ class ChessFunctions:
 
       # move has full hint so came-from-square is completely known
       if len(move) == 5: # like Ba1c3 so full hint
-        if has_full_hint == False:
-          print("Fatal logic error in has_full_hint branch ")
         has_full_hint = True
 
         hint = move[1:3]  # Python strings are just arrays
@@ -395,7 +2830,9 @@ class ChessFunctions:
           ChessFunctions.square_algebraic_to_int(hint)  # no logic needed
         results.landing_square = \
           ChessFunctions.square_algebraic_to_int(move[3:5]) # like "c3"
-        # TODO: check that move is possible
+        if ChessFunctions.can_reach(piece_type_uncased, results.came_from_square,
+          results.landing_square, gs.board_position) == False:
+          raise MoveError(san, gs, "no piece can make the move")
 
       # at this point, +, #, x removed, len(5) eliminated so len is 3 or 4
       elif len(move) == 4: # move has a file or rank hint like "a" in Raf7 or "3" in R3f7
@@ -410,57 +2847,70 @@ class ChessFunctions:
           hint == "7" or hint == "8":
           has_rank_hint = True
           rank_hint = hint
+        else:
+          raise MoveError(san, gs, "malformed piece move")
 
         move = move[:1] + move[2:]  # strip the hint at [1] away (but it's been saved)
 
       # ----------------------------------------------------------------------------------------
 
       # at this point, all piece moves have been trimmed to len = 3, like Nf3
+      # (or are len = 5 with a full hint, in which case came-from square is known)
 
-      if len(move) != 3: print("Fatal logic error. move len not 3 in move_analysis()")
-      results.landing_square = \
-        ChessFunctions.square_algebraic_to_int(move[1:3]) # like "f3"
+      if has_full_hint == False:
+        if len(move) != 3: raise MoveError(san, gs, "malformed piece move")
+        results.landing_square = \
+          ChessFunctions.square_algebraic_to_int(move[1:3]) # like "f3"
 
       # we know the piece being moved, and square where it lands. where did it come from?
-      # find all existing moved-pieces of correct color on the board that meet
-      # file hint or rank hint if they exist. there should be only 1 piece
-      # that meets all the criteria
-      # note: full hint case has already been dealt with
+      # look up the squares it could have come from (table lookup plus blocker walk) and
+      # keep those holding a moved-piece of correct color that meet file hint or rank
+      # hint if they exist. there should be only 1 piece that meets all the criteria
 
       existing_piece_list = []  # actually the squares as int
-      for i in range(64):  # check each square
-        # no hint constraint
-        if has_file_hint == False and \
-        has_rank_hint == False and \
-        ChessFunctions.can_reach(piece_type_uncased, i, results.landing_square,
-          gs.board_position) == True and \
-        gs.board_position[i] == piece_type_cased:
-          existing_piece_list.append(i)
-
-        # file hint constraint like the "c" in Nce6
-        elif has_file_hint == True and \
-        has_rank_hint == False and \
-        ChessFunctions.square_matches_file_hint(i, file_hint) == True and \
-        ChessFunctions.can_reach(piece_type_uncased, i, results.landing_square,
-          gs.board_position) == True and \
-        gs.board_position[i] == piece_type_cased:
+      if has_full_hint == True:
+        existing_piece_list.append(results.came_from_square)
+      elif isinstance(gs, BitboardGameState):  # same search as a mask intersection
+        existing_piece_list = ChessFunctions.from_squares_bitboard(piece_type_cased,
+          results.landing_square, gs, file_hint, rank_hint)
+      else:
+        for i in ChessFunctions.from_squares(piece_type_uncased, results.landing_square,
+          gs.board_position):
+          if gs.board_position[i] != piece_type_cased: continue
+          # file hint constraint like the "c" in Nce6
+          if has_file_hint == True and \
+            ChessFunctions.square_matches_file_hint(i, file_hint) == False: continue
+          # rank hint constraint like the "5" in N5e6
+          if has_rank_hint == True and \
+            ChessFunctions.square_matches_rank_hint(i, rank_hint) == False: continue
           existing_piece_list.append(i)
 
-        # rank hint constraint like the "5" in N5e6
-        elif has_file_hint == False and \
-        has_rank_hint == True and \
-        ChessFunctions.square_matches_rank_hint(i, rank_hint) == True and \
-        ChessFunctions.can_reach(piece_type_uncased, i, results.landing_square,
-          gs.board_position) == True and \
-        gs.board_position[i] == piece_type_cased:
-          existing_piece_list.append(i)
+      if len(existing_piece_list) >= 2:
+        # more than one can get there. when the SAN is right, all but one are pinned to
+        # their king: keep those the legal move generator allows
+        legal_list = []
+        for (came_from, landing, promotion) in ChessFunctions.legal_moves(gs):
+          if landing == results.landing_square and came_from in existing_piece_list:
+            legal_list.append(came_from)
+        existing_piece_list = legal_list
 
       if len(existing_piece_list) == 0:
-        print("Fatal Logic: no possible piece came-from squares found")
+        raise MoveError(san, gs, "no piece can make the move")
       elif len(existing_piece_list) >= 2:
-        print("Fatal logic: 2 or more possible piece came-from squares")
-      elif len(existing_piece_list) == 1:
-        results.came_from_square = existing_piece_list[0]
+        raise MoveError(san, gs, "ambiguous move")
+      results.came_from_square = existing_piece_list[0]
+
+      if piece_type_uncased == "K":
+        # the king may not step onto an attacked square. tested with the king off the
+        # board, like legal_moves(), so it cannot hide behind itself
+        board = gs.board_position
+        if isinstance(gs, BitboardGameState): board = [board[i] for i in range(64)]
+        lifted = board[results.came_from_square]
+        board[results.came_from_square] = "1"
+        attacked = ChessFunctions.square_attacked(board, results.landing_square,
+          gs.color_to_move == "b")
+        board[results.came_from_square] = lifted
+        if attacked == True: raise MoveError(san, gs, "king moves into check")
 
       # filled in at this point: results.piece_moved, results.landing_piece,
       # results.came_from_square, results.landing_square, results.capture,
@@ -532,11 +2982,22 @@ class ChessFunctions:
       if move.find("=") > 0:
         is_promotion = True
 
+      # a pawn promotes exactly when it reaches the last rank, to an N B R or Q. the SAN
+      # letter is upper case for both colors, like e8=Q or e1=Q
+      last_rank = "8"
+      if gs.color_to_move == "b": last_rank = "1"
+      if is_promotion == True:
+        if move.find("=") != len(move) - 2 or "NBRQ".find(move[-1]) < 0 or \
+          move[-3] != last_rank:
+          raise MoveError(san, gs, "malformed promotion")
+      elif move[-1] == last_rank:
+        raise MoveError(san, gs, "pawn must promote")
+
       # pawn mode or capture, branch 1
       if gs.color_to_move == "w" and results.capture == False and is_promotion == False: 
         # move like "e4" (2-step) or e4 (1-step from e3) or e7 (alaways 1-step)
         if len(move) != 2:
-          print("logic error: move length not 2 in branch 1 pawn logic")
+          raise MoveError(san, gs, "malformed pawn move")
 
         if int(move[1]) != 4: # ordinary 1-step pawn move (not to 4th rank)
           results.piece_moved = "P"
@@ -560,6 +3021,8 @@ class ChessFunctions:
             results.notes += ":white pawn move to 4th rank, " + \
               "could have been 2-step but was 1-step, no e.p., no capture, no promotion:"
           elif gs.board_position[results.landing_square + 16] == "P": # came 2-steps away
+            if gs.board_position[results.landing_square + 8] != "1":
+              raise MoveError(san, gs, "pawn blocked")  # cannot jump the square passed over
             #
             # "En passant target square: This is a square over which a pawn
             # has just passed while moving two squares it is given in
@@ -580,6 +3043,8 @@ class ChessFunctions:
               ChessFunctions.square_int_to_algebraic(results.landing_square + 8)
             results.notes += ":white pawn move to 4th rank, 2-step, therefore e.p. square" + \
               " exists, no capture, no promotion:"
+          else:
+            raise MoveError(san, gs, "no piece can make the move")
 
           results.capture = False
           results.pawn_moved = True # reset 50-move ctr
@@ -590,11 +3055,11 @@ class ChessFunctions:
       elif gs.color_to_move == "w" and results.capture == False and is_promotion == True:
         # move like e8=Q
         if len(move) != 4:
-          print("move length not 4 in branch 2 pawn logic")
+          raise MoveError(san, gs, "malformed pawn move")
         results.piece_moved = "P"
         results.landing_piece = move[3] # usually Q
         results.landing_square = \
-          ChessFunctions.square_algebraic_to_int(move[0:3])
+          ChessFunctions.square_algebraic_to_int(move[0:2])
         results.came_from_square = results.landing_square + 8
         results.ep_square = "-"
         results.capture = False
@@ -607,7 +3072,7 @@ class ChessFunctions:
       elif gs.color_to_move == "w" and results.capture == True and is_promotion == False:
         # move like exf6 or exf6+ but +,#,x have been zapped so only ef6 
         if len(move) != 3:
-          print("logic error: move len not 3 in pawn move or capture branch 3")
+          raise MoveError(san, gs, "malformed pawn move")
         # a pawn capture cannot create an e.p. square
         results.piece_moved = "P"
         results.landing_piece = "P"
@@ -615,6 +3080,8 @@ class ChessFunctions:
           ChessFunctions.square_algebraic_to_int(move[1:3])
         fromFile = move[0]  # for exf6+ -> ef6, the "e" part
         toFile = move[1]    # the "f" part
+        if abs(ord(fromFile) - ord(toFile)) != 1:  # from the file on either side only
+          raise MoveError(san, gs, "malformed pawn move")
         if fromFile < toFile: # ex: ef6
           results.came_from_square = results.landing_square + 7
         elif fromFile > toFile: # ex: fe6
@@ -630,13 +3097,15 @@ class ChessFunctions:
       elif gs.color_to_move == "w" and results.capture == True and is_promotion == True:
         # move like exf8=Q has been shaved to ef8=Q
         if len(move) != 5:
-          print("error: move length not 5 as expected to be, in pawn branch 4")
+          raise MoveError(san, gs, "malformed pawn move")
         results.piece_moved = "P"
         results.landing_piece = move[4] # usually a Q
         results.landing_square = \
           ChessFunctions.square_algebraic_to_int(move[1:3])
         fromFile = move[0]
         toFile = move[1]
+        if abs(ord(fromFile) - ord(toFile)) != 1:  # from the file on either side only
+          raise MoveError(san, gs, "malformed pawn move")
         if fromFile < toFile: # ex: ef8
           results.came_from_square = results.landing_square + 7
         elif fromFile > toFile: # ex: fe6
@@ -658,7 +3127,7 @@ class ChessFunctions:
       elif gs.color_to_move == "b" and results.capture == False and is_promotion == False:
         # move like "d5" (possible 2-step) or d6 (1-step from e3) or d2 (always 1-step)
         if len(move) != 2:
-          print("logic error: length not 2 in branch 5 pawn logic")
+          raise MoveError(san, gs, "malformed pawn move")
 
         if int(move[1]) != 5: # ordinary 1-step pawn move (not to 5th rank)
           results.piece_moved = "p"
@@ -683,12 +3152,16 @@ class ChessFunctions:
             results.notes += ":black pawn move to 5th rank, could have been 2-step " + \
               "but was 1-step, no e.p., no capture, no promotion:"
           elif gs.board_position[results.landing_square - 16] == "p": # from 2-steps away
+            if gs.board_position[results.landing_square - 8] != "1":
+              raise MoveError(san, gs, "pawn blocked")  # cannot jump the square passed over
             # ex: black move d5, not from d6, so came from d7, so e.p. square is d6
             results.came_from_square = results.landing_square - 16
             results.ep_square = \
               ChessFunctions.square_int_to_algebraic(results.landing_square - 8)
             results.notes += ":black pawn move to 5th rank, 2-step, therefore e.p. " + \
               "square exists on 4th rank, no capture, no promotion:"
+          else:
+            raise MoveError(san, gs, "no piece can make the move")
 
           results.capture = False
           results.pawn_moved = True  # reset 50-move ctr
@@ -699,7 +3172,7 @@ class ChessFunctions:
       elif gs.color_to_move == "b" and results.capture == False and is_promotion == True:
         # move like d1=Q
         if len(move) != 4:
-          print("logic error: move length not 4 in branch 6 pawn logic")
+          raise MoveError(san, gs, "malformed pawn move")
         results.piece_moved = "p"
         results.landing_piece = move[3].lower() # usually Q -> to q
         results.landing_square = \
@@ -716,7 +3189,7 @@ class ChessFunctions:
       elif gs.color_to_move == "b" and results.capture == True and is_promotion == False:
         # move like exf3 or exf3+ but +,#,x have been zapped so only ef3 
         if len(move) != 3:
-          print("logic error: move len not 3 in pawn move or capture branch 7")
+          raise MoveError(san, gs, "malformed pawn move")
         # a pawn capture cannot create an e.p. square
         results.piece_moved = "p"
         results.landing_piece = "p"
@@ -724,6 +3197,8 @@ class ChessFunctions:
           ChessFunctions.square_algebraic_to_int(move[1:3]) # the f3 part
         fromFile = move[0]  # for exf3+ -> ef3, the "e" part
         toFile = move[1]    # the "f" part
+        if abs(ord(fromFile) - ord(toFile)) != 1:  # from the file on either side only
+          raise MoveError(san, gs, "malformed pawn move")
         if fromFile < toFile: # ex: ef3
           results.came_from_square = results.landing_square - 9
         elif fromFile > toFile: # ex: fe6
@@ -739,8 +3214,7 @@ class ChessFunctions:
       elif gs.color_to_move == "b" and results.capture == True and is_promotion == True:
         # move like exf1=Q has been shaved to ef1=Q
         if len(move) != 5:
-          print("logic error: move length not 5 as expected to be," \
-            + " in pawn branch 8")
+          raise MoveError(san, gs, "malformed pawn move")
 
         results.piece_moved = "p"
         results.landing_piece = move[4].lower()  # usually a Q (to q)
@@ -749,6 +3223,8 @@ class ChessFunctions:
 
         fromFile = move[0]
         toFile = move[1]
+        if abs(ord(fromFile) - ord(toFile)) != 1:  # from the file on either side only
+          raise MoveError(san, gs, "malformed pawn move")
         if fromFile < toFile: # ex: ef1
           results.came_from_square = results.landing_square - 9
         elif fromFile > toFile: # ex: fe1
@@ -783,6 +3259,21 @@ class ChessFunctions:
     # ------------------------------------------------------------------------------------------
 
     elif move == "O-O" or move == "O-O-O":  # + and # have been stripped
+      right = "K"  # castling privilege needed, like "K" for white O-O
+      if move == "O-O-O": right = "Q"
+      if gs.color_to_move == "b": right = right.lower()
+      if gs.castling_info.find(right) < 0:
+        raise MoveError(san, gs, "castling not allowed")
+      for square in CASTLING_PATHS[right]:  # between king and rook
+        if gs.board_position[square] != "1":
+          raise MoveError(san, gs, "castling not allowed")
+      # not out of, through or into check: the king's square, the square it passes over
+      # (where the rook lands) and where it lands
+      (king_from, king_to, rook_from, rook_to) = CASTLING_MOVES[right]
+      for square in (king_from, rook_to, king_to):
+        if ChessFunctions.square_attacked(gs.board_position, square,
+          gs.color_to_move == "b") == True:
+          raise MoveError(san, gs, "castling through check")
       if gs.color_to_move == "w" and move == "O-O":
         results.piece_moved = "K"
         results.landing_square = 62 # g1
@@ -839,7 +3330,7 @@ class ChessFunctions:
       return results
     # castling moves
 
-    return results  # default dummy values
+    raise MoveError(san, gs, "not a move")
   # move_analysis()
 
   # -----------------------------------------------------------------------------------------------
@@ -848,214 +3339,249 @@ class ChessFunctions:
   def can_reach(piece_type_uncased, came_from_square, landing_square, board_position):
     # can landing square be reached from the specified (possible) came-from square?
     # similar logic for N B R Q K regradless of color
-    # called by move_analysis()
+    # knight and king moves are symmetric so a table lookup is enough. for B R Q, work
+    # away from the landing square along each ray until the came-from square or a blocker
 
-    # knight jumps. order not critical here
-    knight_offsets = np.array([-17, -15, -10, -6, 6, 10, 15, 17], dtype=np.int64)
+    if piece_type_uncased == "N":
+      return came_from_square in KNIGHT_TARGETS[landing_square]
+    elif piece_type_uncased == "K":
+      return came_from_square in KING_TARGETS[landing_square]  # blocked path not possible
+    elif piece_type_uncased == "B" or piece_type_uncased == "R" or piece_type_uncased == "Q":
+      for ray in SLIDER_RAYS[piece_type_uncased][landing_square]:  # order critical in a ray
+        for test_square in ray:
+          if test_square == came_from_square:
+            return True
+          if board_position[test_square] != "1": break  # blocked path
+      return False
 
-    # bishop and queen diagonals. order critical to discover blocked paths
-    up_offsets_left = np.array([-9, -18, -27, -36, -45, -54, -63], dtype=np.int64)
-    up_offsets_right = np.array([-7, -14, -21, -28, -35, -42, -49], dtype=np.int64)
-    down_offsets_left = np.array([ 9, 18, 27, 36, 45, 54, 63], dtype=np.int64)
-    down_offsets_right = np.array([ 7, 14, 21, 28, 35, 42, 49], dtype=np.int64)
+    return False  # to keep compiler happy
+  # can_reach()
 
-    # rook and queen left-right, up-down. order critical
-    left_offsets = np.array([-1, -2, -3, -4, -5, -6, -7], dtype=np.int64)
-    right_offsets = np.array([1, 2, 3, 4, 5, 6, 7 ], dtype=np.int64)
-    up_offsets = np.array([-8, -16, -24, -32, -40, -48, -56], dtype=np.int64)
-    down_offsets = np.array([8, 16, 24, 32, 40, 48, 56], dtype=np.int64)
+  # -----------------------------------------------------------------------------------------------
 
-    # king one square any direction (except castling)
-    king_offsets = np.array([-1, 1, -8, 8, -9, 9, -7, 7], dtype=np.int64)
+  @staticmethod
+  def from_squares(piece_type_uncased, landing_square, board_position):
+    # all squares an N B R Q K could have come from to reach landing square, ignoring
+    # what is on them. for B R Q only the first occupied square of each ray qualifies
+    if piece_type_uncased == "N":
+      return KNIGHT_TARGETS[landing_square]
+    elif piece_type_uncased == "K":
+      return KING_TARGETS[landing_square]
+    result = []
+    for ray in SLIDER_RAYS[piece_type_uncased][landing_square]:
+      for test_square in ray:
+        if board_position[test_square] != "1":
+          result.append(test_square)
+          break
+    return result
 
   # -----------------------------------------------------------------------------------------------
 
+  @staticmethod
+  def from_squares_bitboard(piece_type_cased, landing_square, gs, file_hint, rank_hint):
+    # BitboardGameState version of the came-from search in move_analysis(): the squares
+    # the piece can reach the landing square from, intersected with the squares that
+    # hold such a piece, intersected with the file or rank hint if any ("z" for none)
+    piece_type_uncased = piece_type_cased.upper()
     if piece_type_uncased == "N":
-      for i in range(len(knight_offsets)):
-        test_square = landing_square + knight_offsets[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square:
-          return True
-      return False # unable to reach landing square from came-from-square
-    # knight logic
-
-  # -----------------------------------------------------------------------------------------------
-
-    elif piece_type_uncased == "B": # same logic for white and black bishops
-      # could make this efficient by computing which offsets to use (maybe later) 
-      # work away from the landing square to try and eventually hit the came-from square
-      # need a clear path
-
-      # check up and to the left squares
-      for i in range(len(up_offsets_left)):
-        test_square = landing_square + up_offsets_left[i]  # possible came-from square
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_color(landing_square) == \
-          ChessFunctions.square_color(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-      # check up and to the right squares
-      for i in range(len(up_offsets_right)):
-        test_square = landing_square + up_offsets_right[i]  # possible came-from square
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_color(landing_square) == \
-          ChessFunctions.square_color(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-      # check down and to the left
-      for i in range(len(down_offsets_left)):
-        test_square = landing_square + down_offsets_left[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_color(landing_square) == \
-          ChessFunctions.square_color(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-      # check down and to right
-      for i in range(len(down_offsets_right)):
-        test_square = landing_square + down_offsets_right[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_color(landing_square) == \
-          ChessFunctions.square_color(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
- 
-      return False
-    # end bishop logic
-
-  # -----------------------------------------------------------------------------------------------
-
-    elif piece_type_uncased == "R":
-      # work away from the landing square to try and eventually hit the came-from square
-      # need a clear path so order is important
-      # left_offsets = [-1, -2, -3, -4, -5, -6, -7 ]
-      # right_offsets = [1, 2, 3, 4, 5, 6, 7 ]
-      # up_offsets = [-8, -16, -24, -32, -40, -48, -56 ]
-      # down_offsets = [8, 16, 24, 32, 40, 48, 56 ]
-
-      # could make this more efficient in severl ways . .
-      for i in range(len(left_offsets)):
-        test_square = landing_square + left_offsets[i]  # could wrap to wrong file
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_rank(landing_square) == \
-          ChessFunctions.square_rank(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-
-      for i in range(len(right_offsets)):
-        test_square = landing_square + right_offsets[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_rank(landing_square) == \
-          ChessFunctions.square_rank(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-
-      for i in range(len(up_offsets)):
-        test_square = landing_square + up_offsets[i]  # could wrap to wrong rank
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_file(landing_square) == \
-          ChessFunctions.square_file(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
- 
-      for i in range(len(down_offsets)):
-        test_square = landing_square + down_offsets[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_file(landing_square) == \
-          ChessFunctions.square_file(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
- 
-      return False
-    # end rook logic
-
-  # -----------------------------------------------------------------------------------------------
-
-    elif piece_type_uncased == "Q":
-      # bishop-style movements
-      for i in range(len(up_offsets_left)):
-        test_square = landing_square + up_offsets_left[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_color(landing_square) == \
-          ChessFunctions.square_color(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-
-      for i in range(len(up_offsets_right)):
-        test_square = landing_square + up_offsets_right[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_color(landing_square) == \
-          ChessFunctions.square_color(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-
-      for i in range(len(down_offsets_left)):
-        test_square = landing_square + down_offsets_left[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_color(landing_square) == \
-          ChessFunctions.square_color(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
- 
-      for i in range(len(down_offsets_right)):
-        test_square = landing_square + down_offsets_right[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_color(landing_square) == \
-          ChessFunctions.square_color(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-
-      # rook-style movements
-      for i in range(len(left_offsets)):
-        test_square = landing_square + left_offsets[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_rank(landing_square) == \
-          ChessFunctions.square_rank(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path 
-
-      for i in range(len(right_offsets)):
-        test_square = landing_square + right_offsets[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_rank(landing_square) == \
-          ChessFunctions.square_rank(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-
-      for i in range(len(up_offsets)):
-        test_square = landing_square + up_offsets[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_file(landing_square) == \
-          ChessFunctions.square_file(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path
-
-      for i in range(len( down_offsets)):
-        test_square = landing_square + down_offsets[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square and ChessFunctions.square_file(landing_square) == \
-          ChessFunctions.square_file(came_from_square):
-          return True
-        if board_position[test_square] != "1": break  # blocked path 
+      mask = KNIGHT_MASKS[landing_square]
+    elif piece_type_uncased == "K":
+      mask = KING_MASKS[landing_square]
+    else:
+      occupied = gs.occupied()
+      mask = 0
+      for ray in SLIDER_RAYS[piece_type_uncased][landing_square]:
+        for test_square in ray:
+          bit = 1 << test_square
+          if occupied & bit:  # first piece on the ray is the only candidate
+            mask |= bit
+            break
+    mask &= gs.bitboards[BitboardGameState.PIECES.index(piece_type_cased)]
+    if file_hint != "z": mask &= FILE_MASKS[file_hint]
+    if rank_hint != "z": mask &= RANK_MASKS[rank_hint]
+
+    result = []
+    while mask:
+      low = mask & -mask
+      result.append(low.bit_length() - 1)
+      mask ^= low
+    return result
 
-      return False
-    # queen logic
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def legal_moves(gs):
+    # every legal move of the side to move in gs (a GameState or BitboardGameState), as
+    # (came_from_square, landing_square, promotion) tuples for play_move(). promotion is
+    # what a pawn becomes, cased like "Q" or "q", else None. castling is the king's move,
+    # like (60, 62, None) for white O-O
+    # moves come from the same tables as can_reach() and are tested without playing them:
+    # a pinned piece stays on the line of its pin, in check a move must take or block the
+    # checker (in double check only the king moves), the king never steps onto an
+    # attacked square, and castling needs the privilege, an empty path and a king not in
+    # or passing through check. an e.p. capture is tested with both pawns lifted, since it
+    # can uncover an attack along the rank
+    if isinstance(gs, BitboardGameState):
+      board = [gs.board_position[i] for i in range(64)]
+    else:
+      board = list(gs.board_position)
+    white = gs.color_to_move == "w"
+    if white == True:
+      own = "PNBRQK"; enemy = "pnbrqk"; forward = -8; start_row = 6; last_row = 0
+    else:
+      own = "pnbrqk"; enemy = "PNBRQK"; forward = 8; start_row = 1; last_row = 7
+    king = own[5]
+    king_square = board.index(king)
+
+    # checks and pins. walk out from the king along each ray: an enemy slider is a checker
+    # if it is the first piece, a pinner if exactly one own piece is in between
+    pins = {}        # square of a pinned piece -> squares on the line of its pin
+    evasions = None  # in check: the squares a move other than the king's must land on
+    n_checkers = 0
+    for (rays, sliders) in ((BISHOP_RAYS[king_square], enemy[2] + enemy[4]),
+      (ROOK_RAYS[king_square], enemy[3] + enemy[4])):
+      for ray in rays:
+        shield = -1  # own piece between the king and a possible pinner
+        for i in range(len(ray)):
+          piece = board[ray[i]]
+          if piece == "1": continue
+          if own.find(piece) >= 0:
+            if shield >= 0: break  # two own pieces, no pin
+            shield = ray[i]
+            continue
+          if sliders.find(piece) >= 0:
+            if shield < 0:
+              n_checkers += 1
+              evasions = set(ray[:i+1])  # block anywhere up to and including the capture
+            else:
+              pins[shield] = set(ray[:i+1])
+          break
+    for square in KNIGHT_TARGETS[king_square]:
+      if board[square] == enemy[1]:
+        n_checkers += 1
+        evasions = set([square])
+    for square in PAWN_CAPTURES[own[0]][king_square]:
+      if board[square] == enemy[0]:
+        n_checkers += 1
+        evasions = set([square])
+
+    # king moves, tested with the king off the board so it cannot hide behind itself
+    moves = []
+    board[king_square] = "1"
+    for square in KING_TARGETS[king_square]:
+      if own.find(board[square]) >= 0: continue
+      if ChessFunctions.square_attacked(board, square, not white) == False:
+        moves.append((king_square, square, None))
+    board[king_square] = king
+    if n_checkers >= 2: return moves
+
+    if n_checkers == 0:
+      for right in gs.castling_info:
+        if right not in CASTLING_MOVES or (right == right.upper()) != white: continue
+        (king_from, king_to, rook_from, rook_to) = CASTLING_MOVES[right]
+        if king_square != king_from or board[rook_from] != own[3]: continue
+        blocked = False
+        for square in CASTLING_PATHS[right]:
+          if board[square] != "1": blocked = True
+        if blocked == True: continue
+        if ChessFunctions.square_attacked(board, rook_to, not white) == True or \
+          ChessFunctions.square_attacked(board, king_to, not white) == True: continue
+        moves.append((king_from, king_to, None))
+
+    ep = -1
+    if gs.ep_square != "-": ep = ChessFunctions.square_algebraic_to_int(gs.ep_square)
+    for square in range(64):
+      piece = board[square]
+      if piece == "1" or piece == king or own.find(piece) < 0: continue
+      targets = []
+      if piece == own[0]:  # pawn
+        ahead = square + forward
+        if board[ahead] == "1":
+          targets.append(ahead)
+          if square // 8 == start_row and board[ahead + forward] == "1":
+            targets.append(ahead + forward)
+        for target in PAWN_CAPTURES[piece][square]:
+          if enemy.find(board[target]) >= 0:
+            targets.append(target)
+          elif target == ep and board[target] == "1" and board[ep - forward] == enemy[0]:
+            captured = ep - forward
+            board[square] = "1"; board[captured] = "1"; board[ep] = piece
+            if ChessFunctions.square_attacked(board, king_square, not white) == False:
+              moves.append((square, ep, None))
+            board[square] = piece; board[captured] = enemy[0]; board[ep] = "1"
+      elif piece == own[1]:  # knight
+        for target in KNIGHT_TARGETS[square]:
+          if own.find(board[target]) < 0: targets.append(target)
+      else:  # B R Q
+        for ray in SLIDER_RAYS[piece.upper()][square]:
+          for target in ray:
+            if board[target] == "1":
+              targets.append(target)
+              continue
+            if enemy.find(board[target]) >= 0: targets.append(target)
+            break
+
+      line = pins.get(square)
+      for target in targets:
+        if evasions is not None and target not in evasions: continue
+        if line is not None and target not in line: continue
+        if piece == own[0] and target // 8 == last_row:
+          for promotion in own[4:0:-1]:  # Q R B N
+            moves.append((square, target, promotion))
+        else:
+          moves.append((square, target, None))
+    return moves
 
   # -----------------------------------------------------------------------------------------------
 
-    elif piece_type_uncased == "K":
-      # king_offsets =[-1, 1, -8, 8, -9, 9, -7, 7]
-      for i in range(len(king_offsets)):
-        test_square = landing_square + king_offsets[i]
-        if test_square < 0 or test_square > 63: continue
-        if test_square == came_from_square:
-          return True
-        # blocked path not possible
+  @staticmethod
+  def square_attacked(board_position, square, by_white):
+    # is square attacked by a white (by_white True) or black piece? board_position is a
+    # GameState-style board of 64 one-character strings. the piece on square, if any,
+    # does not matter
+    if by_white == True:
+      (pawn, knight, bishop, rook, queen, king) = "PNBRQK"
+      pawn_squares = PAWN_CAPTURES["p"][square]
+    else:
+      (pawn, knight, bishop, rook, queen, king) = "pnbrqk"
+      pawn_squares = PAWN_CAPTURES["P"][square]
+    for test_square in pawn_squares:
+      if board_position[test_square] == pawn: return True
+    for test_square in KNIGHT_TARGETS[square]:
+      if board_position[test_square] == knight: return True
+    for test_square in KING_TARGETS[square]:
+      if board_position[test_square] == king: return True
+    for ray in BISHOP_RAYS[square]:
+      for test_square in ray:
+        piece = board_position[test_square]
+        if piece != "1":
+          if piece == bishop or piece == queen: return True
+          break
+    for ray in ROOK_RAYS[square]:
+      for test_square in ray:
+        piece = board_position[test_square]
+        if piece != "1":
+          if piece == rook or piece == queen: return True
+          break
+    return False
 
-      return False
-    # king logic
+  # -----------------------------------------------------------------------------------------------
 
-    return False  # to keep compiler happy
-  # can_reach()
+  @staticmethod
+  def perft(gs, depth):
+    # number of legal move sequences depth plies long from gs, the standard test of a move
+    # generator against published counts (20, 400, 8902 . . from the starting position)
+    # gs is played on with play_move() and restored with unmake_move()
+    moves = ChessFunctions.legal_moves(gs)
+    if depth <= 1:
+      if depth == 1: return len(moves)  # leaves are counted, not played
+      return 1
+    nodes = 0
+    for move in moves:
+      undo = ChessFunctions.play_move(gs, move)
+      nodes += ChessFunctions.perft(gs, depth - 1)
+      ChessFunctions.unmake_move(gs, undo)
+    return nodes
 
   # -----------------------------------------------------------------------------------------------
 
@@ -1166,10 +3692,38 @@ class ChessFunctions:
 
   # -----------------------------------------------------------------------------------------------
 
+  @staticmethod
+  def compute_zobrist(gs):
+    # Zobrist key of a GameState (or BitboardGameState) from scratch: pieces, side to move,
+    # castling privileges and e.p. square. move counters are not part of the key
+    key = 0
+    for sq in range(64):
+      piece = gs.board_position[sq]
+      if piece != "1": key ^= ZOBRIST_PIECES[piece][sq]
+    if gs.color_to_move == "b": key ^= ZOBRIST_BLACK_TO_MOVE
+    return key ^ ChessFunctions.zobrist_castling_ep(gs.castling_info, gs.ep_square)
+
+  # -----------------------------------------------------------------------------------------------
+
+  @staticmethod
+  def zobrist_castling_ep(castling_info, ep_square):
+    # the part of a Zobrist key for castling info like "KQk" and e.p. square like "e3"
+    key = 0
+    if castling_info != "-":
+      for symbol in castling_info:
+        key ^= ZOBRIST_CASTLING[symbol]
+    if ep_square != "-":
+      key ^= ZOBRIST_EP_FILES[ep_square[0]]
+    return key
+
+  # -----------------------------------------------------------------------------------------------
+
   @staticmethod
   def copy_of(gs):
-    # copy of a GameState object, by value
-    result = GameState()
+    # copy of a GameState (or BitboardGameState) object, by value
+    if isinstance(gs, BitboardGameState):
+      return gs.copy()
+    result = GameState(False)
     for i in range(64):
       result.board_position[i] = gs.board_position[i]
     result.color_to_move = gs.color_to_move
@@ -1177,10 +3731,32 @@ class ChessFunctions:
     result.ep_square = gs.ep_square
     result.fifty_move_ctr = gs.fifty_move_ctr
     result.full_move_ctr = gs.full_move_ctr
+    result.rank_fens = list(gs.rank_fens)  # encoded ranks are still valid
+    result.zobrist_key = gs.zobrist_key
     return result
 
   # ----------------------------------------------------------------------------------------------
 
+  @staticmethod
+  def rank_to_fen(board_position, rank_idx):
+    # one rank of the board to FEN text like "R3K2R". rank_idx 0 is rank 8 (a8..h8)
+    fen = ""
+    consec_spaces = 0
+    for i in range(rank_idx * 8, rank_idx * 8 + 8):
+      curr = board_position[i]
+      if curr == "1":
+        consec_spaces += 1
+      else:  # curr is a piece token like "N" or "p"
+        if consec_spaces > 0:
+          fen += str(consec_spaces)  # flush
+          consec_spaces = 0
+        fen += curr
+    if consec_spaces > 0:
+      fen += str(consec_spaces)
+    return fen
+
+  # ----------------------------------------------------------------------------------------------
+
   @staticmethod
   def board_position_to_fen(board_position):
     # position[] like ".."R","1","1","1",..", FEN like "../R3K2R/.."